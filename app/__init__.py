@@ -1,30 +1,14 @@
-import os
-import platform
-import logging
-from flask import Flask
-from logging.handlers import RotatingFileHandler
+"""CPAPI, a web front end and library for the Check Point Management API.
 
-ostype = platform.system()
+The Flask app is only created when app.app is first used, so the API
+client, local DB and CLI can be imported without the web server. This
+needs Python 3.7, run.py and the WSGI file import app.web directly.
+"""
 
-if ostype == 'Windows':
-    BASEDIR = '{}\\'.format(os.getcwd())
-if ostype == 'Linux':
-    BASEDIR = '/var/log/cpapi/'
 
-app = Flask(__name__)
-app.config['version'] = '1.4.3'
-app.config['BASEDIR'] = BASEDIR
-
-formatter = logging.Formatter('%(asctime)s %(levelname)s - '
-                              '%(filename)s:%(funcName)s:%(lineno)d - '
-                              '%(message)s')
-handler = RotatingFileHandler(
-    '{}cpapi.log'.format(app.config['BASEDIR']),
-    maxBytes=10000000,
-    backupCount=10)
-handler.setFormatter(formatter)
-app.logger.setLevel('DEBUG')
-app.logger.addHandler(handler)
-app.secret_key = os.urandom(25)
-
-from app import views
+def __getattr__(name):
+    if name == 'app':
+        from app.web import app
+        return app
+    raise AttributeError('module {!r} has no attribute {!r}'.format(
+        __name__, name))
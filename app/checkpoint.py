@@ -1,24 +1,101 @@
 import ast
 import base64
+import collections
+import ipaddress
+import itertools
 import json
+import logging
 import os
+import re
 import requests
+import threading
 import time
 
-from app import app
+from concurrent.futures import ThreadPoolExecutor
+
 from app import localdb
+from app import profiling
+from app import settings
+from app.ipindex import addressindex
+from app.metrics import Metrics, metrics
+from app.paging import pagesizer
+from app.rulecache import RulebaseCache
+from app import transport
+from app.transport import APITransport, StreamedPage
+
+log = logging.getLogger(__name__)
+
+
+class APIError(Exception):
+    """Raised when a paginated call does not return a usable page."""
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def localstore(database):
+    """Local DB and rulebase cache of a management server or domain, shared
+    by every session logged in to it."""
+    with _stores_lock:
+        if database not in _stores:
+            if not os.path.exists(database):
+                log.info('Creating local DB {}'.format(database))
+                localdb.createdb(database)
+            dbobj = localdb.cplocaldb(database)
+            _stores[database] = (dbobj, RulebaseCache(
+                dbobj, settings.config['RULEBASE_CACHE_SIZE']))
+        return _stores[database]
+
+
+# Commands, targets and layers per (server, domain, API version), shared by
+# every session and refreshed in the background once older than the TTL.
+_bootstrap = {}
+_bootstrap_lock = threading.Lock()
 
 
 class CheckPoint_API(object):
+    # Black omitted as defalut option.
+    all_colors = [
+        'aquamarine', 'blue', 'crete blue', 'burlywood', 'cyan',
+        'dark green', 'khaki', 'orchid', 'dark orange', 'dark sea green',
+        'pink', 'turquoise', 'dark blue', 'firebrick', 'brown',
+        'forest green', 'gold', 'dark gold', 'gray', 'dark gray',
+        'light green', 'lemon chiffon', 'coral', 'sea green', 'sky blue',
+        'magenta', 'purple', 'slate blue', 'violet red', 'navy blue',
+        'olive', 'orange', 'red', 'sienna', 'yellow'
+    ]
+
     def __init__(self):
-        self.limit = 50
-        self.offset = 0
+        # UIDs asked for per show-objects call, page sizes of the show
+        # commands come from pagesizer.
+        self.object_limit = 500
         self.ipaddress = None
         self.domain = None
         self.sid = None
+        self.version = None
+        self.username = None
+        # Login payload kept to log in again once the session expired.
+        self.credentials = None
+        # Seconds the server keeps an idle session, from the login reply.
+        self.session_timeout = 600
+        # Seconds the server clock is ahead of UTC, None until a login
+        # reply told us.
+        self.utcoffset = None
+        self.last_call = 0
         self.port = '443'
+        self.lastlayer = None
+        # Rule changes are queued while batching and published together.
+        self.batch = False
+        self.changes = []
         self.local_obj = 0
         self.remote_obj = 0
+        self.sync_report = collections.OrderedDict()
+        # Called with (fetched, total) objects while a sync runs.
+        self.sync_progress = None
+        # Calls of the running sync, summarized in sync_calls when it ends.
+        self.sync_metrics = None
+        self.sync_calls = []
         # Consider single/plural dict of these to eliminate service hacking.
         self.obj_map = {
             'host': 'hosts',
@@ -32,10 +109,26 @@ class CheckPoint_API(object):
         }
         self.request_headers = {
             'Content-Type': 'application/json',
-            'User-Agent': 'CPAPI v{}'.format(app.config['version'])
+            'User-Agent': 'CPAPI v{}'.format(settings.config['version'])
         }
         # Permanently Disable verify for now.
         requests.packages.urllib3.disable_warnings()
+        self.transport = APITransport(
+            pool_size=settings.config['API_POOL_SIZE'],
+            retries=settings.config['API_RETRIES'],
+            backoff=settings.config['API_BACKOFF'])
+        # Held while a change and its publish are made in this session.
+        self.lock = threading.RLock()
+        self.login_lock = threading.Lock()
+        self.last_used = time.time()
+        # Caps concurrent calls this session makes to the management server.
+        self.inflight = threading.BoundedSemaphore(
+            settings.config['API_CONCURRENCY'])
+        # Large show-* pages are parsed while they download, see streampages.
+        self.stream = settings.config['API_STREAM']
+        if self.stream and transport.ijson is None:
+            log.warning('API_STREAM needs ijson, pages are read whole.')
+            self.stream = False
 
     @staticmethod
     def base64_ascii(base64resp):
@@ -48,40 +141,148 @@ class CheckPoint_API(object):
         return 'https://{}:{}/web_api/'.format(self.ipaddress, self.port)
 
     def verify_db(self):
-        if self.domain:
-            self.localdb = '{}{}_{}.db'.format(app.config['BASEDIR'],
-                                               self.ipaddress, self.domain)
-        else:
-            self.localdb = '{}{}.db'.format(app.config['BASEDIR'],
-                                            self.ipaddress)
-        if not os.path.exists(self.localdb):
-            app.logger.info('Creating local DB {}'.format(self.localdb))
-            localdb.createdb(self.localdb)
-        self.dbobj = localdb.cplocaldb(self.localdb)
+        self.localdb = localdb.dbname(settings.config['BASEDIR'],
+                                      self.ipaddress, self.domain)
+        self.dbobj, self.rulecache = localstore(self.localdb)
 
     def verify_obj(self):
         self.countallobjects()
         self.local_obj = self.dbobj.object_counter()
 
-    def api_call(self, command, json_payload):
-        if self.sid:
-            self.request_headers.update({'X-chkp-sid': self.sid})
+    @staticmethod
+    def timeout(command):
+        """Connect and read timeout for a command."""
+        return settings.config['API_TIMEOUTS'].get(command,
+                                              settings.config['API_TIMEOUT'])
+
+    def api_call(self, command, json_payload, stream=False):
+        sid = self.sid
+        response = self.post(command, json_payload, sid, stream)
+        if (command not in ('login', 'logout') and self.expired(response)
+                and self.relogin(sid)):
+            self.observe('retried', command, 'session')
+            response = self.post(command, json_payload, self.sid, stream)
+        return response
+
+    def observe(self, event, command, *args):
+        """Record a call event in metrics and those of a running sync."""
+        for registry in (metrics, self.sync_metrics):
+            if registry is not None:
+                getattr(registry, event)(command, *args)
+
+    def post(self, command, json_payload, sid, stream=False):
+        headers = dict(self.request_headers)
+        if sid:
+            headers['X-chkp-sid'] = sid
+        data = json.dumps(json_payload)
+        started = time.time()
+        self.observe('started', command)
         try:
-            app.logger.info('Command Issued: {}'.format(command))
-            response = requests.post(
-                self.url + command,
-                data=json.dumps(json_payload),
-                headers=self.request_headers,
-                timeout=(15, 300),
-                verify=False)
-            return response
+            log.info('Command Issued: {}'.format(command))
+            with self.inflight, profiling.span('api', command):
+                response = self.transport.post(
+                    self.url + command,
+                    data=data,
+                    headers=headers,
+                    timeout=self.timeout(command),
+                    stream=stream)
         except requests.exceptions.RequestException as e:
-            app.logger.error('{}'.format(e))
+            self.observe('finished', command, 'error', time.time() - started,
+                         0, len(data))
+            log.error('{}'.format(e))
             return 'Error: {}'.format(e)
+        if stream:
+            received = int(response.headers.get('Content-Length', 0))
+        else:
+            received = len(response.content)
+        self.observe('finished', command, response.status_code,
+                     response.seconds, response.waited, len(data), received)
+        self.observe('retried', command, 'connection', response.retries)
+        log.debug('{} {} in {:.3f}s, {} bytes'.format(
+            command, response.status_code, response.seconds, received))
+        if response.status_code < 500:
+            self.last_call = time.time()
+        return response
+
+    @staticmethod
+    def expired(response):
+        """Whether a reply says the session is no longer valid. A 403 on
+        its own is a missing permission and is left to the caller."""
+        try:
+            if response.status_code == 401:
+                return True
+            # Successful replies may be streamed, only errors are read here.
+            return response.status_code >= 400 and response.json().get(
+                'code') == 'generic_err_wrong_session_id'
+        except (AttributeError, ValueError):
+            pass
+        return False
+
+    def relogin(self, sid):
+        """Log in again after the session sid expired. Calls failing
+        together only log in once, True when a valid session exists."""
+        if self.credentials is None:
+            return False
+        with self.login_lock:
+            if self.sid != sid:
+                return True
+            log.info('Session of {} expired, logging in again'.format(
+                self.owner))
+            response = self.post('login', self.credentials, None)
+            try:
+                if response.status_code != 200:
+                    return False
+            except AttributeError:
+                return False
+            self.loggedin(response)
+            return True
+
+    def loggedin(self, response):
+        """Take the sid and timeouts of a successful login reply."""
+        login = response.json()
+        self.sid = login['sid']
+        self.version = login.get('api-server-version')
+        self.session_timeout = login.get('session-timeout',
+                                         self.session_timeout)
+        self.utcoffset = self.parseoffset(
+            login.get('last-login-was-at', {}).get('iso-8601', ''))
+
+    @staticmethod
+    def parseoffset(timestamp):
+        """UTC offset in seconds of an ISO 8601 time such as
+        2019-04-07T13:32+0300, None when it has none."""
+        if timestamp.endswith('Z'):
+            return 0
+        match = re.search(r'([+-])(\d\d):?(\d\d)$', timestamp)
+        if match is None:
+            return None
+        offset = int(match.group(2)) * 3600 + int(match.group(3)) * 60
+        return -offset if match.group(1) == '-' else offset
+
+    def keepalive_due(self):
+        """Whether the session is close enough to its timeout to need a
+        keepalive, any other call keeps it alive as well."""
+        idle = time.time() - self.last_call
+        return idle > self.session_timeout - settings.config['KEEPALIVE_MARGIN']
+
+    def alive(self):
+        """Keep the session alive if it is about to time out, logging in
+        again if it already expired. False when no session could be
+        kept."""
+        if not self.sid:
+            return False
+        if not self.keepalive_due():
+            return True
+        response = self.keepalive()
+        try:
+            return response.status_code == 200
+        except AttributeError:
+            return False
 
     def login(self, ipaddress, username, password, domain=None):
         """Login to Check Point API."""
         self.ipaddress = ipaddress
+        self.username = username
         payload = {
             'user': username,
             'password': password,
@@ -91,9 +292,19 @@ class CheckPoint_API(object):
             payload.update({'domain': domain})
         response = self.api_call('login', payload)
         if response.status_code == 200:
+            self.credentials = payload
+            self.loggedin(response)
             self.verify_db()
         return response
 
+    @property
+    def owner(self):
+        """Who background jobs started from this session belong to."""
+        if self.domain:
+            return '{}@{}/{}'.format(self.username, self.ipaddress,
+                                     self.domain)
+        return '{}@{}'.format(self.username, self.ipaddress)
+
     def publish(self):
         """Publish changes to Check Point."""
         response = self.api_call('publish', {})
@@ -115,20 +326,69 @@ class CheckPoint_API(object):
         return response
 
     def pre_data(self):
-        """Data to establish after login to make less calls later to the API."""
-        # Black omitted as defalut option.
-        self.all_colors = [
-            'aquamarine', 'blue', 'crete blue', 'burlywood', 'cyan',
-            'dark green', 'khaki', 'orchid', 'dark orange', 'dark sea green',
-            'pink', 'turquoise', 'dark blue', 'firebrick', 'brown',
-            'forest green', 'gold', 'dark gold', 'gray', 'dark gray',
-            'light green', 'lemon chiffon', 'coral', 'sea green', 'sky blue',
-            'magenta', 'purple', 'slate blue', 'violet red', 'navy blue',
-            'olive', 'orange', 'red', 'sienna', 'yellow'
-        ]
-        self.all_commands = self.getallcommands()
-        self.all_targets = self.getalltargets()
-        self.all_layers = self.getalllayers()
+        """Called after a web login to load the commands, targets and layers
+        before the first page needs them."""
+        self.bootstrap_cache()
+
+    @property
+    def all_commands(self):
+        return self.bootstrap_cache()['commands']
+
+    @property
+    def all_targets(self):
+        return self.bootstrap_cache()['targets']
+
+    @property
+    def all_layers(self):
+        return self.bootstrap_cache()['layers']
+
+    def bootstrap_cache(self):
+        """Cached commands, targets and layers of the server. A stale entry
+        is still returned while a refresh runs in the background."""
+        key = (self.ipaddress, self.domain or '', self.version)
+        with _bootstrap_lock:
+            entry = _bootstrap.get(key)
+            stale = (entry is not None and not entry['refreshing']
+                     and time.time() - entry['loaded'] >
+                     settings.config['PREDATA_TTL'])
+            if stale:
+                entry['refreshing'] = True
+        if entry is None:
+            entry = self.loadbootstrap(key)
+        elif stale:
+            threading.Thread(
+                target=self.refreshbootstrap, args=(key, entry),
+                daemon=True).start()
+        return entry
+
+    def loadbootstrap(self, key):
+        """Fetch commands, targets and layers concurrently."""
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            commands = executor.submit(profiling.carry(self.getallcommands))
+            targets = executor.submit(profiling.carry(self.getalltargets))
+            layers = executor.submit(profiling.carry(self.getalllayers))
+        entry = {
+            'loaded': time.time(),
+            'refreshing': False,
+            'commands': commands.result(),
+            'targets': targets.result(),
+            'layers': layers.result()
+        }
+        with _bootstrap_lock:
+            _bootstrap[key] = entry
+        log.info('Loaded commands, targets and layers of {} in '
+                 '{:.2f}s'.format(key[0], time.time() - started))
+        return entry
+
+    def refreshbootstrap(self, key, entry):
+        try:
+            self.loadbootstrap(key)
+        except Exception as e:
+            log.error('Refreshing commands, targets and layers of {} '
+                      'failed: {}'.format(key[0], e))
+            with _bootstrap_lock:
+                entry['refreshing'] = False
 
     def addhost(self, hostpayload):
         add_host_response = self.api_call('add-host', hostpayload)
@@ -155,133 +415,363 @@ class CheckPoint_API(object):
             show_obj_response.json()['object']['type']), type_obj_data)
         return type_obj_response
 
+    def getpage(self, command, payload, offset, limit):
+        """Retrieve a single page of a show command."""
+        page_data = dict(payload, offset=offset, limit=limit)
+        log.info('Retrieving {} offset:{}, limit:{}'.format(
+            command, offset, limit))
+        started = time.time()
+        response = self.api_call(command, page_data)
+        try:
+            page = response.data
+        except (AttributeError, ValueError):
+            raise APIError('{} offset {}: {}'.format(command, offset,
+                                                     response))
+        if 'total' not in page:
+            raise APIError('{} offset {}: {}'.format(
+                command, offset, page.get('message', page)))
+        self.measure(command, False, offset, limit, page,
+                     time.time() - started, len(response.content))
+        return page
+
+    def pagesize(self, command, stream=False):
+        return pagesizer.size((self.ipaddress, command, stream))
+
+    def measure(self, command, stream, offset, limit, fields, seconds,
+                size=None):
+        """Feed a page to pagesizer and return how many items it held."""
+        returned = self.returned(fields, offset)
+        pagesizer.record((self.ipaddress, command, stream), limit, returned,
+                         seconds, size, offset + returned < fields['total'])
+        return returned
+
+    @staticmethod
+    def returned(fields, offset):
+        """Items in a page asked for from offset, to is the 1-based position
+        of its last item."""
+        return max(fields.get('to', offset) - offset, 0)
+
+    def pages(self, command, fetch, stream=False):
+        """Yield fetch(offset, limit) for every page of a show command in
+        order, fetch returns the (fields, result) of one page.
+
+        Each page is sized by pagesizer when it is requested and starts after
+        the last item actually returned. The first pages provide the total,
+        the remaining spans are fetched concurrently, bounded by
+        API_CONCURRENCY."""
+        first = self.span(fetch, 0, self.pagesize(command, stream))
+        for page in first:
+            yield page
+        fields = first[-1][0]
+
+        def spans(offset):
+            while offset < fields['total']:
+                limit = self.pagesize(command, stream)
+                yield offset, limit
+                offset += limit
+
+        for pages in self.imap(lambda span: self.span(fetch, *span),
+                               spans(fields.get('to', 0))):
+            for page in pages:
+                yield page
+
+    def span(self, fetch, offset, limit):
+        """Pages holding limit items from offset, asking for the rest from
+        the last item returned while the server returns fewer."""
+        pages = []
+        end = offset + limit
+        while True:
+            fields, result = fetch(offset, end - offset)
+            pages.append((fields, result))
+            returned = self.returned(fields, offset)
+            offset += returned
+            if not returned or offset >= min(end, fields['total']):
+                return pages
+
+    def iterpages(self, command, payload):
+        """Yield every page of a show command in order, see pages."""
+
+        def fetch(offset, limit):
+            page = self.getpage(command, payload, offset, limit)
+            return page, page
+
+        for page, _ in self.pages(command, fetch):
+            yield page
+
+    def streampage(self, command, payload, offset, limit, keys):
+        """Request a single page of a show command as a StreamedPage of the
+        arrays under keys."""
+        page_data = dict(payload, offset=offset, limit=limit)
+        log.info('Streaming {} offset:{}, limit:{}'.format(
+            command, offset, limit))
+        response = self.api_call(command, page_data, stream=True)
+        try:
+            if response.status_code == 200:
+                return StreamedPage(response, keys)
+            message = response.data.get('message', response.text)
+        except AttributeError:
+            message = response
+        except ValueError:
+            message = response.text
+        if hasattr(response, 'close'):
+            response.close()
+        raise APIError('{} offset {}: {}'.format(command, offset, message))
+
+    def streampages(self, command, payload, keys, consume):
+        """Like iterpages for pages parsed while they download, so the size
+        of a page does not decide memory use.
+
+        consume(page) is called on the thread fetching each page with its
+        StreamedPage, (fields, result) is yielded per page in order where
+        fields are the top level scalars of the page."""
+
+        def fetch(offset, limit):
+            started = time.time()
+            page = self.streampage(command, payload, offset, limit, keys)
+            try:
+                result = consume(page)
+                fields = page.finish()
+            finally:
+                page.close()
+            if 'total' not in fields:
+                raise APIError('{} offset {}: no total'.format(
+                    command, offset))
+            self.measure(command, True, offset, limit, fields,
+                         time.time() - started)
+            return fields, result
+
+        return self.pages(command, fetch, stream=True)
+
+    def storeobjects(self, page, uids=None):
+        """Write the objects of a StreamedPage to localdb in batches, returns
+        how many there were. Their UIDs are added to uids if given."""
+        batch = []
+        count = 0
+        for _, cpobject in page:
+            batch.append(cpobject)
+            if uids is not None:
+                uids.add(cpobject['uid'])
+            if len(batch) == settings.config['STREAM_BATCH']:
+                self.dbobj.insert_objects(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            self.dbobj.insert_objects(batch)
+        return count + len(batch)
+
+    @staticmethod
+    def imap(func, iterable):
+        """Ordered map of func over iterable on a bounded thread pool."""
+        workers = settings.config['API_CONCURRENCY']
+        func = profiling.carry(func)
+        iterable = iter(iterable)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = collections.deque(
+                executor.submit(func, item)
+                for item in itertools.islice(iterable, workers * 2))
+            while pending:
+                result = pending.popleft().result()
+                for item in itertools.islice(iterable, 1):
+                    pending.append(executor.submit(func, item))
+                yield result
+
+    def paginate(self, command, payload, key):
+        """Collect the items under key from every page of a show command."""
+        return [
+            item for page in self.iterpages(command, payload)
+            for item in page[key]
+        ]
+
+    def eachtype(self, func):
+        """Run func(sinobj, pluobj) for every object type concurrently and
+        return the results keyed by pluobj in obj_map order."""
+        with ThreadPoolExecutor(max_workers=len(self.obj_map)) as executor:
+            futures = collections.OrderedDict(
+                (pluobj, executor.submit(profiling.carry(func), sinobj,
+                                         pluobj))
+                for sinobj, pluobj in self.obj_map.items())
+        return collections.OrderedDict(
+            (pluobj, future.result()) for pluobj, future in futures.items())
+
+    def report(self, pluobj, fetched, total, started):
+        """Record progress of one object type in sync_report."""
+        self.sync_report[pluobj] = {
+            'fetched': fetched,
+            'total': total,
+            'seconds': round(time.time() - started, 2)
+        }
+        if self.sync_progress is not None:
+            entries = list(self.sync_report.values())
+            self.sync_progress(
+                sum(entry['fetched'] for entry in entries),
+                sum(entry['total'] for entry in entries))
+
+    def log_report(self, started):
+        """Log per type timing of the last sync."""
+        for pluobj, entry in self.sync_report.items():
+            log.info('{}: {}/{} objects in {}s'.format(
+                pluobj, entry['fetched'], entry['total'], entry['seconds']))
+        log.info('Object sync took {:.2f}s'.format(time.time() - started))
+
     def getallobjects(self):
-        """Collect objects for localdb."""
-        for sinobj, pluobj in self.obj_map.items():
-            self.offset = 0
-            local_limit = 500
-            objs_data = {'limit': local_limit, 'offset': self.offset}
-            app.logger.info(
-                'Retrieving {} from remote database. Offset:{}, Limit:{}'.
-                format(pluobj, self.offset, local_limit))
-            objs_result = self.api_call('show-{}'.format(pluobj), objs_data)
-            for obj in objs_result.json()['objects']:
-                self.dbobj.insert_object(obj)
-            if objs_result.json()['total'] != 0:
-                while objs_result.json()['to'] != objs_result.json()['total']:
-                    self.offset += 500
-                    moreobjs = {'limit': local_limit, 'offset': self.offset}
-                    app.logger.info(
-                        'Retrieving {} from remote database. Offset:{}, Limit:{}'.
-                        format(pluobj, self.offset, local_limit))
-                    objs_result = self.api_call('show-{}'.format(pluobj),
-                                                moreobjs)
-                    for obj in objs_result.json()['objects']:
-                        self.dbobj.insert_object(obj)
-        self.dbobj.dbconn.commit()
-
-    def deldifobjects(self):
-        local_uids = self.dbobj.local_uids()
-        remote_uids = self.getalluid()
-        for luid in local_uids:
-            if luid not in remote_uids:
-                self.dbobj.delete_object(luid)
-        self.dbobj.dbconn.commit()
-
-    def getdifobjects(self):
-        """Collect objects uid for localdb comparison and add if they don't exist."""
-        for sinobj, pluobj in self.obj_map.items():
-            self.offset = 0
-            local_limit = 500
-            objs_data = {
-                'limit': local_limit,
-                'offset': self.offset,
-                'details-level': 'uid'
+        """Collect objects for localdb, one concurrent fetch per type.
+        Returns the UIDs fetched."""
+        started = time.time()
+        self.sync_report.clear()
+        for pluobj in self.obj_map.values():
+            self.report(pluobj, 0, 0, started)
+
+        def fetchtype(sinobj, pluobj):
+            uids = set()
+            typestart = time.time()
+            if self.stream:
+                for fields, _ in self.streampages(
+                        'show-{}'.format(pluobj), {}, ('objects', ),
+                        lambda page: self.storeobjects(page, uids)):
+                    self.report(pluobj, len(uids), fields['total'],
+                                typestart)
+                return uids
+            for page in self.iterpages('show-{}'.format(pluobj), {}):
+                self.dbobj.insert_objects(page['objects'])
+                uids.update(cpobject['uid'] for cpobject in page['objects'])
+                self.report(pluobj, len(uids), page['total'], typestart)
+            return uids
+
+        fetched = set().union(*self.eachtype(fetchtype).values())
+        self.log_report(started)
+        return fetched
+
+    def getobjects(self, uids):
+        """Collect objects by UID in batches of show-objects for localdb."""
+        uids = list(uids)
+        batches = [
+            uids[index:index + self.object_limit]
+            for index in range(0, len(uids), self.object_limit)
+        ]
+
+        def getbatch(batch):
+            batch_data = {
+                'uids': batch,
+                'limit': len(batch),
+                'details-level': 'standard'
             }
-            objs_result = self.api_call('show-{}'.format(pluobj), objs_data)
-            for obj in objs_result.json()['objects']:
-                if not self.dbobj.uidcheck(obj):
-                    self.getoneobject(obj, sinobj)
-            if objs_result.json()['total'] != 0:
-                while objs_result.json()['to'] != objs_result.json()['total']:
-                    self.offset += 500
-                    moreobjs = {
-                        'limit': local_limit,
-                        'offset': self.offset,
-                        'details-level': 'uid'
-                    }
-                    objs_result = self.api_call('show-{}'.format(pluobj),
-                                                moreobjs)
-                    for obj in objs_result.json()['objects']:
-                        if not self.dbobj.uidcheck(obj):
-                            self.getoneobject(obj, sinobj)
-        self.dbobj.dbconn.commit()
-
-    def getoneobject(self, uid, cptype):
-        """Collect single object for getdifobjects."""
-        get_obj_data = {'uid': uid}
-        get_obj_result = self.api_call('show-{}'.format(cptype), get_obj_data)
-        self.dbobj.insert_object(get_obj_result.json())
+            if self.stream:
+                page = self.streampage('show-objects', batch_data, 0,
+                                       len(batch), ('objects', ))
+                try:
+                    self.storeobjects(page)
+                    page.finish()
+                finally:
+                    page.close()
+                return
+            page = self.getpage('show-objects', batch_data, 0, len(batch))
+            self.dbobj.insert_objects(page['objects'])
+
+        for _ in self.imap(getbatch, batches):
+            pass
+
+    def syncobjects(self, full=False, progress=None):
+        """Full retrieve on first use, afterwards only the changes since the
+        last sync are applied. progress is called with (fetched, total)."""
+        started = time.time()
+        self.sync_progress = progress
+        self.sync_metrics = Metrics()
+        try:
+            self.fetchobjects(full)
+        finally:
+            self.sync_progress = None
+            self.sync_calls = self.sync_metrics.summary()
+            self.sync_metrics = None
+            self.log_calls(started)
+        self.dbobj.set_state('last_sync', str(started))
+
+    def log_calls(self, started):
+        """Log the API calls of the last sync, time not spent waiting on
+        the server is cpapi's own."""
+        for row in self.sync_calls:
+            log.info('{command}: {calls} calls, {errors} errors, {retries} '
+                     'retries, {seconds}s ({waited}s waiting), mean '
+                     '{mean}s, slowest {slowest}s, {sent}/{received} bytes '
+                     'out/in'.format(**row))
+        calls = sum(row['calls'] for row in self.sync_calls)
+        seconds = sum(row['seconds'] for row in self.sync_calls)
+        log.info('Sync took {:.2f}s, {} API calls took {:.2f}s '
+                 'together'.format(time.time() - started, calls, seconds))
+
+    def fetchobjects(self, full):
+        last_sync = self.dbobj.get_state('last_sync')
+        if full or last_sync is None or self.dbobj.object_counter() == 0:
+            log.info('Full retrieve of objects.')
+            self.getallobjects()
+        else:
+            try:
+                self.getchanges(float(last_sync))
+            except (APIError, AttributeError, KeyError, ValueError) as e:
+                # Changes since the last sync are unknown, modified objects
+                # are only caught by retrieving everything again.
+                log.warning('Incremental sync failed, retrieving all '
+                            'objects: {}'.format(e))
+                fetched = self.getallobjects()
+                removed = self.dbobj.local_uids() - fetched
+                log.info('Removing {} objects deleted on the server'.format(
+                    len(removed)))
+                self.dbobj.delete_objects(removed)
+
+    def getchanges(self, since):
+        """Apply objects added, modified and deleted since a posix time."""
+        started = time.time()
+        self.sync_report.clear()
+        # from-date is read in the server's time zone, taken from the login
+        # reply. Without it reach back as far as UTC-12, upserts make
+        # overlapping changes harmless.
+        since -= settings.config['SYNC_OVERLAP']
+        if self.utcoffset is None:
+            since -= 12 * 3600
+        else:
+            since += self.utcoffset
+        from_date = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(since))
+        log.info('Retrieving changes since {}'.format(from_date))
+        response = self.api_call('show-changes', {'from-date': from_date})
+        try:
+            changes_task = response.data
+        except (AttributeError, ValueError):
+            raise APIError('show-changes: {}'.format(response))
+        if 'task-id' not in changes_task:
+            raise APIError(changes_task.get('message', changes_task))
+        task = self.waittask(changes_task['task-id'])
+        changed = set()
+        deleted = set()
+        for detail in task.get('task-details', []):
+            for change in detail.get('changes', []):
+                operations = change.get('operations', {})
+                for obj in operations.get('added-objects', []):
+                    changed.add((obj['uid'], obj.get('type')))
+                for obj in operations.get('modified-objects', []):
+                    obj = obj.get('new-object', obj)
+                    changed.add((obj['uid'], obj.get('type')))
+                for obj in operations.get('deleted-objects', []):
+                    deleted.add(obj['uid'])
+        changed = set(uid for uid, cptype in changed if cptype in self.obj_map)
+        self.dbobj.delete_objects(deleted)
+        self.getobjects(changed - deleted)
+        self.report('changed', len(changed), len(changed), started)
+        self.report('deleted', len(deleted), len(deleted), started)
+        self.log_report(started)
 
     def countallobjects(self):
         """Count objects for local comparison"""
-        # Reset count for consecutive pulls.
-        self.remote_obj = 0
-        for sinobj, pluobj in self.obj_map.items():
+        def counttype(sinobj, pluobj):
             objs_data = {'limit': 1}
             objs_result = self.api_call('show-{}'.format(pluobj), objs_data)
-            if 'total' in objs_result.json():
-                self.remote_obj += objs_result.json()['total']
-
-    def getalluid(self):
-        all_uids = []
-        for sinobj, pluobj in self.obj_map.items():
-            self.offset = 0
-            local_limit = 500
-            objs_data = {
-                'limit': local_limit,
-                'offset': self.offset,
-                'details-level': 'uid'
-            }
-            obj_response = self.api_call('show-{}'.format(pluobj), objs_data)
-            for uid in obj_response.json()['objects']:
-                all_uids.append(uid)
-            if obj_response.json()['total'] != 0:
-                while obj_response.json()['to'] != obj_response.json()['total']:
-                    self.offset += 500
-                    moreobjs = {
-                        'limit': local_limit,
-                        'offset': self.offset,
-                        'details-level': 'uid'
-                    }
-                    obj_response = self.api_call('show-{}'.format(pluobj),
-                                                 moreobjs)
-                    for uid in obj_response.json()['objects']:
-                        all_uids.append(uid)
-        return all_uids
+            return objs_result.json().get('total', 0)
+
+        self.remote_obj = sum(self.eachtype(counttype).values())
 
     def getalllayers(self):
         """Retrieve all rule base layers from management server."""
-        all_layers = []
-        self.offset = 0
-        get_layers_data = {'limit': self.limit, 'offset': self.offset}
-        get_layers_result = self.api_call('show-access-layers',
-                                          get_layers_data)
-        for layer in get_layers_result.json()['access-layers']:
-            all_layers.append((layer['name'], layer['uid']))
-
-        # In case there is ever a way to have 0 layers
-        if get_layers_result.json()['total'] != 0:
-            while get_layers_result.json()['to'] != get_layers_result.json(
-            )['total']:
-                self.offset += 50
-                get_more_layers = {'limit': self.limit, 'offset': self.offset}
-                get_layers_result = self.api_call('show-access-layers',
-                                                  get_more_layers)
-                for layer in get_layers_result.json()['access-layers']:
-                    all_layers.append((layer['name'], layer['uid']))
-
-        return all_layers
+        return [(layer['name'], layer['uid'])
+                for layer in self.paginate('show-access-layers', {},
+                                           'access-layers')]
 
     def customcommand(self, command, payload):
         """Validate payload and send command to server."""
@@ -301,113 +791,321 @@ class CheckPoint_API(object):
 
     def getalltargets(self):
         """Get all gateways and servers from Check Point."""
-        all_targets = []
-        self.offset = 0
-        get_targets_data = {'limit': self.limit, 'offset': self.offset}
-        get_targets_result = self.api_call('show-gateways-and-servers',
-                                           get_targets_data)
-        for target in get_targets_result.json()['objects']:
-            all_targets.append(target['name'])
-
-        while get_targets_result.json()['to'] != get_targets_result.json(
-        )['total']:
-            self.offset += 50
-            get_more_targets = {'limit': self.limit, 'offset': self.offset}
-            get_targets_result = self.api_call('show-gateways-and-servers',
-                                               get_more_targets)
-            for target in get_targets_result.json()['objects']:
-                all_targets.append(target['name'])
-
-        return all_targets
-
-    def runcommand(self, target, scriptcontent):
-        """Issue command against Check Point targets, verify task is complete on each gateways
-        and return response for each target."""
-        taskreturn = []
+        return [target['name']
+                for target in self.paginate('show-gateways-and-servers', {},
+                                            'objects')]
+
+    def runscript(self, target, scriptcontent):
+        """Start a script on Check Point targets, the response holds a task
+        per target."""
         run_script_data = {
             'script-name': 'cpapi',
             'script': scriptcontent,
             'targets': target
         }
-        response = self.api_call('run-script', run_script_data)
-        if response.status_code == 200:
-            if 'tasks' in response.json():
-                for task in response.json()['tasks']:
-                    tasktrg = task['target']
-                    taskid = task['task-id']
-                    taskperc = 0
-                    while taskperc < 100:
-                        taskresponse = self.gettask(taskid)
-                        taskperc = taskresponse.json()['tasks'][0][
-                            'progress-percentage']
-                        if taskperc == 100:
-                            if taskresponse.json()['tasks'][0]['task-details'][
-                                    0]['responseMessage']:
-                                base64resp = taskresponse.json()['tasks'][0][
-                                    'task-details'][0]['responseMessage']
-                                asciiresp = self.base64_ascii(base64resp)
-                                taskreturn.append({
-                                    'target':
-                                    tasktrg,
-                                    'status':
-                                    taskresponse.json()['tasks'][0]['status'],
-                                    'response':
-                                    asciiresp
-                                })
-                            else:
-                                taskreturn.append({
-                                    'target':
-                                    tasktrg,
-                                    'status':
-                                    taskresponse.json()['tasks'][0]['status'],
-                                    'response':
-                                    'Not Available'
-                                })
-                        time.sleep(1)
-                return taskreturn
-        elif response.status_code == 404:
-            return response.text
+        return self.api_call('run-script', run_script_data)
+
+    def polltasks(self, tasks):
+        """Yield the result of each run-script task as its target finishes,
+        targets still running at the deadline are reported as timed out."""
+        targets = {task['task-id']: task['target'] for task in tasks}
+        for task in self.finishedtasks(list(targets)):
+            yield self.taskresult(targets.pop(task['task-id']), task)
+        for target in targets.values():
+            yield {
+                'target': target,
+                'status': 'timed out',
+                'response': 'Not Available'
+            }
+
+    def taskresult(self, target, task):
+        details = task.get('task-details') or [{}]
+        if details[0].get('responseMessage'):
+            response = self.base64_ascii(details[0]['responseMessage'])
         else:
-            return response
+            response = 'Not Available'
+        return {
+            'target': target,
+            'status': task['status'],
+            'response': response
+        }
+
+    def finishedtasks(self, taskids, timeout=None):
+        """Yield tasks as they complete, for at most timeout seconds which
+        defaults to TASK_DEADLINE.
+
+        Every pending task is polled with one show-task call, the interval
+        doubles while nothing finishes and resets when something does."""
+        pending = set(taskids)
+        initial = settings.config['TASK_POLL_INITIAL']
+        delay = initial
+        deadline = time.time() + (timeout or settings.config['TASK_DEADLINE'])
+        while pending:
+            response = self.gettask(sorted(pending))
+            finished = [
+                task for task in response.data['tasks']
+                if task['task-id'] in pending
+                and task['progress-percentage'] == 100
+            ]
+            for task in finished:
+                pending.discard(task['task-id'])
+                yield task
+            remaining = deadline - time.time()
+            if not pending or remaining <= 0:
+                return
+            delay = initial if finished else min(
+                delay * 2, settings.config['TASK_POLL_MAX'])
+            time.sleep(min(delay, remaining))
+
+    def waittask(self, taskid):
+        """Poll a task until it completes and return it."""
+        for task in self.finishedtasks([taskid]):
+            return task
+        raise APIError('Task {} did not finish in time'.format(taskid))
 
     def gettask(self, task):
-        """Function for runcommand to get task status."""
+        """Status of one task-id or a list of them."""
         get_task_data = {'task-id': task, 'details-level': 'full'}
         response = self.api_call('show-task', get_task_data)
         return response
 
-    def get_local_objs(self):
-        return self.dbobj.allobjects()
+    def revision(self):
+        """UID of the last published session, identifies the policy state."""
+        response = self.api_call('show-last-published-session', {})
+        try:
+            return response.json().get('uid')
+        except (AttributeError, ValueError):
+            return None
 
     def add_rule(self, ruledata):
         """Recieves rule number from form and uses lastlayer from class."""
-        addruleresp = self.api_call('add-access-rule', ruledata)
-        if addruleresp.status_code == 200:
-            response = self.publish()
-            if response.status_code != 200:
-                return response.text
-        else:
-            return addruleresp.text
+        return self.change({
+            'action': 'add',
+            'layer': ruledata['layer'],
+            'position': ruledata['position'],
+            'rule': ruledata
+        })
 
-    def delete_rule(self, rulenumber):
+    def delete_rule(self, rulenumber, uid=None):
         """Recieves rule number from form and uses lastlayer from class."""
-        delruledata = {'layer': self.lastlayer, 'rule-number': rulenumber}
-        delruleresp = self.api_call('delete-access-rule', delruledata)
-        if delruleresp.status_code == 200:
+        return self.change({
+            'action': 'delete',
+            'layer': self.lastlayer,
+            'number': self.rulenumber(rulenumber),
+            'uid': uid
+        })
+
+    def move_rule(self, rulenumber, position, uid=None):
+        """Move a rule of lastlayer to a number, top or bottom."""
+        number = self.rulenumber(rulenumber)
+        position = str(position or '').strip().lower()
+        if position not in ('top', 'bottom'):
+            if not position.isdigit() or int(position) < 1:
+                raise ValueError('Invalid position "{}", use a rule '
+                                 'number, top or bottom.'.format(position))
+            position = int(position)
+        return self.change({
+            'action': 'move',
+            'layer': self.lastlayer,
+            'number': number,
+            'uid': uid,
+            'position': position
+        })
+
+    @staticmethod
+    def rulenumber(value):
+        """Rule number of a form value, ValueError when it is none."""
+        value = str(value).strip()
+        if not value.isdigit() or int(value) < 1:
+            raise ValueError('Invalid rule number "{}".'.format(value))
+        return int(value)
+
+    def change(self, change):
+        """Queue a rule change while batching, otherwise apply and publish it
+        right away. Queued deletes and moves keep the UID of the rule the
+        number referred to, earlier changes of the batch renumber rules."""
+        if not self.batch:
+            return self._publish_changes([change])
+        if change['action'] != 'add' and not change.get('uid'):
+            if not change['layer']:
+                raise ValueError('Select a layer first.')
+            try:
+                rules = self.showrulebase(change['layer'])
+                change['uid'] = self.findrule(rules, change).get('uid')
+            except APIError as e:
+                raise ValueError('Unable to load the layer: {}'.format(e))
+            except ValueError:
+                raise ValueError('No rule number {} in the layer.'.format(
+                    change['number']))
+        with self.lock:
+            self.changes.append(change)
+        return None
+
+    def apply_changes(self):
+        """Apply every queued rule change and publish them together. The
+        queue is kept if a change fails so it can be discarded."""
+        with self.lock:
+            changes, self.changes = self.changes, []
+            feedback = self._publish_changes(changes)
+            if feedback is not None:
+                self.changes = changes
+            return feedback
+
+    def discard_changes(self):
+        with self.lock:
+            discarded, self.changes = len(self.changes), []
+        return discarded
+
+    @staticmethod
+    def changecall(change):
+        """API command and payload of a queued rule change."""
+        if change['action'] == 'add':
+            return 'add-access-rule', change['rule']
+        data = {'layer': change['layer']}
+        if change.get('uid'):
+            data['uid'] = change['uid']
+        else:
+            data['rule-number'] = change['number']
+        if change['action'] == 'delete':
+            return 'delete-access-rule', data
+        position = change['position']
+        data['new-position'] = int(position) if str(
+            position).isdigit() else position
+        return 'set-access-rule', data
+
+    def _publish_changes(self, changes):
+        """Make rule changes in this session and publish them with a single
+        publish, cached rulebases are patched instead of refetched. Returns
+        an error message, nothing is published when a change fails."""
+        if not changes:
+            return None
+        with self.lock:
+            revision = self.revision()
+            layers = collections.OrderedDict()
+            for change in changes:
+                layers.setdefault(change['layer'], []).append(change)
+            cached = {
+                layer: self.rulecache.get(layer, self.domain, revision)
+                for layer in layers
+            }
+            for number, change in enumerate(changes, 1):
+                command, data = self.changecall(change)
+                response = self.api_call(command, data)
+                try:
+                    if response.status_code == 200:
+                        change['response'] = response.data
+                        continue
+                    message = response.text
+                except AttributeError:
+                    message = response
+                self.discard()
+                return ('Change {} of {} failed, nothing was published: '
+                        '{}'.format(number, len(changes), message))
+            # Someone else published since the cached rules were read, they
+            # lack those changes and must be fetched again.
+            if self.revision() != revision:
+                cached = dict.fromkeys(layers)
             response = self.publish()
-            if response.status_code != 200:
-                return response.text
+            try:
+                published = response.status_code == 200
+                message = response.text
+            except AttributeError:
+                published, message = False, response
+            if not published:
+                for layer in layers:
+                    self.rulecache.invalidate(layer, self.domain)
+                return message
+            log.info('Published {} rule changes'.format(len(changes)))
+            for layer, layerchanges in layers.items():
+                if cached[layer] is None:
+                    self.rulecache.invalidate(layer, self.domain)
+                else:
+                    self.patchrulebase(layer, response, cached[layer],
+                                       layerchanges)
+            return None
+
+    def patchrulebase(self, layer_uid, publish, rules, changes):
+        """Apply our own published changes to a cached rulebase instead of
+        refetching the layer."""
+        try:
+            if 'task-id' in publish.data:
+                self.waittask(publish.data['task-id'])
+            for change in changes:
+                if change['action'] == 'add':
+                    rule, objects = self.flattenrule(change['response'])
+                    self.insertrule(rules, change['position'],
+                                    self.filterpolicyrule(rule, objects))
+                    continue
+                rule = self.findrule(rules, change)
+                self.deleterule(rules, rule['number'])
+                if change['action'] == 'move':
+                    self.insertrule(rules, change['position'], rule)
+        except (KeyError, TypeError, ValueError) as e:
+            log.info('Dropping cached rulebase {}: {}'.format(
+                layer_uid, e))
+            self.rulecache.invalidate(layer_uid, self.domain)
+            return
+        self.rulecache.put(layer_uid, self.domain, self.revision(), rules)
+
+    @staticmethod
+    def findrule(rules, change):
+        """Cached rule a change refers to, by UID when known."""
+        for rule in rules:
+            if rule['type'] != 'rule':
+                continue
+            if change.get('uid'):
+                if rule.get('uid') == change['uid']:
+                    return rule
+            elif rule['number'] == change['number']:
+                return rule
+        raise ValueError('rule {} not cached'.format(
+            change.get('uid') or change['number']))
+
+    @staticmethod
+    def insertrule(rules, position, rule):
+        """Insert a filtered rule at a position and renumber those after."""
+        numbers = [r['number'] for r in rules if r['type'] == 'rule']
+        last = max(numbers) if numbers else 0
+        if position == 'top':
+            number = 1
+        elif position == 'bottom':
+            number = last + 1
+        else:
+            number = int(position)
+        if not 1 <= number <= last + 1:
+            raise ValueError('position {} out of range'.format(position))
+        rule['number'] = number
+        index = len(rules)
+        for i, existing in enumerate(rules):
+            if existing['type'] == 'rule' and existing['number'] >= number:
+                if index == len(rules):
+                    index = i
+                existing['number'] += 1
+        rules.insert(index, rule)
+
+    @staticmethod
+    def deleterule(rules, number):
+        """Remove a filtered rule by number and renumber those after."""
+        for i, existing in enumerate(rules):
+            if existing['type'] == 'rule' and existing['number'] == number:
+                del rules[i]
+                break
         else:
-            return delruleresp.text
+            raise ValueError('rule {} not cached'.format(number))
+        for existing in rules:
+            if existing['type'] == 'rule' and existing['number'] > number:
+                existing['number'] -= 1
 
-    def dorulebase(self, rules, rulebase):
-        """Recieves json respone of showrulebase and sends rule dictionaries into
+    def dorulebase(self, rules, rulebase, objects=None):
+        """Recieves a page of showrulebase and sends rule dictionaries into
         filterpolicyrule."""
-        for rule in rulebase.json()['rulebase']:
+        if objects is None:
+            objects = self.objectnames(rulebase)
+        for rule in rulebase['rulebase']:
             if 'type' in rule:
                 thetype = rule['type']
                 if thetype == 'access-rule':
-                    filteredrule = self.filterpolicyrule(rule, rulebase.json())
+                    filteredrule = self.filterpolicyrule(rule, objects)
                     rules.append(filteredrule)
                 else:
                     # Section can have no name just like rule...
@@ -418,98 +1116,195 @@ class CheckPoint_API(object):
                     rules.append({'type': 'section', 'name': section})
             if 'rulebase' in rule:
                 for subrule in rule['rulebase']:
-                    filteredrule = self.filterpolicyrule(
-                        subrule, rulebase.json())
+                    filteredrule = self.filterpolicyrule(subrule, objects)
                     rules.append(filteredrule)
         return rules
 
-    def showrulebase(self, layer_uid):
-        """Issues API call to manager and holds response of rules until all
-        filtering is complete."""
-        self.offset = 0
-        show_rulebase_data = {
+    def showrulebase(self, layer_uid, revision=None):
+        """Filtered rules of a layer, served from the rulebase cache while
+        the policy revision is unchanged."""
+        revision = revision or self.revision()
+        rules = self.rulecache.get(layer_uid, self.domain, revision)
+        if rules is None:
+            rules = self.fetchrulebase(layer_uid)
+            self.rulecache.put(layer_uid, self.domain, revision, rules)
+        return rules
+
+    @staticmethod
+    def rulebase_data(layer_uid):
+        return {
             'uid': layer_uid,
             'details-level': 'standard',
-            'offset': self.offset,
-            'limit': self.limit,
             'use-object-dictionary': 'true'
         }
-        app.logger.info(
-            'Retrieving rules from layer:{}, offset:{}, limit:{}'.format(
-                layer_uid, self.offset, self.limit))
-        show_rule_result = self.api_call('show-access-rulebase',
-                                         show_rulebase_data)
 
+    def fetchrulebase(self, layer_uid):
+        """Issues API call to manager and holds response of rules until all
+        filtering is complete."""
         rules = []
+        if self.stream:
+            for _, page in self.streampages(
+                    'show-access-rulebase', self.rulebase_data(layer_uid),
+                    ('rulebase', 'objects-dictionary'), self.streamrules):
+                rules.extend(page)
+            return rules
+        for page in self.iterpages('show-access-rulebase',
+                                   self.rulebase_data(layer_uid)):
+            self.dorulebase(rules, page)
+        return rules
+
+    def streamrules(self, page):
+        """Filtered rules of a StreamedPage of show-access-rulebase. Only
+        the names of the objects-dictionary are kept while it is read."""
+        rulebase = []
+        objects = {}
+        for key, item in page:
+            if key == 'rulebase':
+                rulebase.append(item)
+            else:
+                objects[item['uid']] = item['name']
+        return self.dorulebase([], {'rulebase': rulebase}, objects)
 
-        self.dorulebase(rules, show_rule_result)
-        while show_rule_result.json()['to'] != show_rule_result.json()['total']:
-            self.offset += 50
-            show_more_rulebase = {
-                'uid': layer_uid,
-                'details-level': 'standard',
-                'offset': self.offset,
-                'limit': self.limit,
-                'use-object-dictionary': 'true'
+    def rulewindow(self, layer_uid, offset, limit, search='', load=True):
+        """A window of filtered rules for the policy view.
+
+        offset and limit count rules, each window starts with the section
+        its first rule belongs to. Uncached layers are windowed by the API
+        directly so the first rows do not wait for the whole layer. A search
+        needs the whole layer, without load None is returned instead of
+        fetching an uncached one."""
+        revision = self.revision()
+        rules = self.rulecache.get(layer_uid, self.domain, revision)
+        if rules is None and search and not load:
+            return None
+        if rules is None and not search:
+            page = self.getpage('show-access-rulebase',
+                                self.rulebase_data(layer_uid), offset, limit)
+            return {
+                'offset': offset,
+                'total': page['total'],
+                'rules': self.dorulebase([], page)
             }
-            app.logger.info(
-                'Retrieving rules from layer:{}, offset:{}, limit:{}'.format(
-                    layer_uid, self.offset, self.limit))
-            show_rule_result = self.api_call('show-access-rulebase',
-                                             show_more_rulebase)
-            self.dorulebase(rules, show_rule_result)
+        if search:
+            rules = self.searchrules(layer_uid, search, revision)
+        elif rules is None:
+            rules = self.showrulebase(layer_uid, revision)
+        window, total = self.slicerules(rules, offset, limit)
+        return {'offset': offset, 'total': total, 'rules': window}
 
-        return rules
+    def lookup(self, value, include_any=False):
+        """Objects covering or inside an address or prefix, directly or
+        through groups, and the access rules referencing them."""
+        network = ipaddress.ip_network(value, strict=False)
+        direct, groups = addressindex(self.dbobj).matching(network)
+        names = self.dbobj.object_names(direct | groups)
+        objects = sorted(({
+            'uid': uid,
+            'name': names[uid][0],
+            'type': names[uid][1],
+            'via': 'address' if uid in direct else 'group'
+        } for uid in names), key=lambda obj: obj['name'])
+        rules = []
+        revision = self.revision()
+        for layer_name, layer_uid in self.all_layers:
+            index = self.rulecache.index(layer_uid, self.domain, revision)
+            if index is None:
+                self.showrulebase(layer_uid, revision)
+                index = self.rulecache.index(layer_uid, self.domain,
+                                             revision)
+            found = index.referencing(direct | groups,
+                                      include_any=include_any)
+            for position, fields in found.items():
+                rule = index.rules[position]
+                rules.append({
+                    'layer': layer_name,
+                    'layer-uid': layer_uid,
+                    'number': rule['number'],
+                    'name': rule['name'],
+                    'fields': fields
+                })
+        return {'address': str(network), 'objects': objects, 'rules': rules}
+
+    @staticmethod
+    def slicerules(rules, offset, limit):
+        """Rules offset to offset + limit with their sections, and the total
+        number of rules."""
+        window = []
+        section = None
+        count = 0
+        for rule in rules:
+            if rule['type'] == 'section':
+                section = rule
+                continue
+            if offset <= count < offset + limit:
+                if section is not None:
+                    window.append(section)
+                    section = None
+                window.append(rule)
+            count += 1
+        return window, count
 
     @staticmethod
-    def filterpolicyrule(rule, show_rulebase_result):
-        """The actual filtering of a rule."""
+    def objectnames(rulebase):
+        """UID to name lookup for the objects-dictionary of a rulebase page."""
+        return {
+            obj['uid']: obj['name']
+            for obj in rulebase.get('objects-dictionary', [])
+        }
+
+    def searchrules(self, layer_uid, query, revision=None):
+        """Rules of a layer matching a RuleIndex query, with their
+        sections."""
+        revision = revision or self.revision()
+        index = self.rulecache.index(layer_uid, self.domain, revision)
+        if index is None:
+            self.showrulebase(layer_uid, revision)
+            index = self.rulecache.index(layer_uid, self.domain, revision)
+        return index.filter(query)
+
+    @staticmethod
+    def flattenrule(rule):
+        """Split a rule with inline objects, as returned by add-access-rule,
+        into a rule of UIDs and a UID to name lookup for filterpolicyrule."""
+        objects = {}
+
+        def uid(obj):
+            if isinstance(obj, dict):
+                objects[obj['uid']] = obj['name']
+                return obj['uid']
+            return obj
+
+        flat = dict(rule)
+        for field in ('source', 'destination', 'service', 'install-on'):
+            flat[field] = [uid(obj) for obj in rule.get(field, [])]
+        flat['action'] = uid(rule['action'])
+        flat['track'] = dict(rule['track'], type=uid(rule['track']['type']))
+        flat.setdefault('rule-number', None)
+        return flat, objects
+
+    @staticmethod
+    def filterpolicyrule(rule, objects):
+        """The actual filtering of a rule, objects maps UID to name."""
         filteredrule = {}
-        if 'name' in rule:
-            name = rule['name']
-        else:
-            name = ''
-        num = rule['rule-number']
-        src = rule['source']
-        src_all = []
-        dst = rule['destination']
-        dst_all = []
-        srv = rule['service']
-        srv_all = []
-        act = rule['action']
+        name = objects.get(rule.get('name', ''), rule.get('name', ''))
+        num = objects.get(rule['rule-number'], rule['rule-number'])
+        act = objects.get(rule['action'], rule['action'])
         if rule['track']['type']:
             trc = rule['track']['type']
+            trc = objects.get(trc, trc)
         else:
             trc = rule['track']
-        trg = rule['install-on']
-        trg_all = []
-        for obj in show_rulebase_result['objects-dictionary']:
-            if name == obj['uid']:
-                name = obj['name']
-            if num == obj['uid']:
-                num = obj['name']
-            if act == obj['uid']:
-                act = obj['name']
-            if trc == obj['uid']:
-                trc = obj['name']
-        for srcobj in src:
-            for obj in show_rulebase_result['objects-dictionary']:
-                if srcobj == obj['uid']:
-                    src_all.append((obj['name'], srcobj))
-        for dstobj in dst:
-            for obj in show_rulebase_result['objects-dictionary']:
-                if dstobj == obj['uid']:
-                    dst_all.append((obj['name'], dstobj))
-        for srvobj in srv:
-            for obj in show_rulebase_result['objects-dictionary']:
-                if srvobj == obj['uid']:
-                    srv_all.append((obj['name'], srvobj))
-        for trgobj in trg:
-            for obj in show_rulebase_result['objects-dictionary']:
-                if trgobj == obj['uid']:
-                    trg_all.append((obj['name'], trgobj))
+        src_all = [(objects[uid], uid) for uid in rule['source']
+                   if uid in objects]
+        dst_all = [(objects[uid], uid) for uid in rule['destination']
+                   if uid in objects]
+        srv_all = [(objects[uid], uid) for uid in rule['service']
+                   if uid in objects]
+        trg_all = [(objects[uid], uid) for uid in rule['install-on']
+                   if uid in objects]
         filteredrule.update({
             'type': 'rule',
+            'uid': rule.get('uid'),
             'number': num,
             'name': name,
             'source': src_all,
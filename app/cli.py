@@ -0,0 +1,248 @@
+"""Command line use of the API client without the web app.
+
+    python -m app sync --server 10.0.0.1 --user admin
+    python -m app export --server 10.0.0.1 --type host > hosts.json
+    python -m app run-script --server 10.0.0.1 --user admin \
+        --target gw1 --script 'fw stat'
+    python -m app rulebase --server 10.0.0.1 --user admin Network
+    python -m app import objects.csv --server 10.0.0.1 --user admin
+
+The password is read from CPAPI_PASSWORD or prompted for. Modules are
+imported by the command that needs them, export only reads the local DB.
+"""
+import argparse
+import csv
+import getpass
+import io
+import json
+import logging
+import os
+import sys
+
+from app import settings
+
+log = logging.getLogger(__name__)
+
+
+def connect(args):
+    """Logged in CheckPoint_API for the server arguments."""
+    from app.checkpoint import CheckPoint_API
+
+    apisession = CheckPoint_API()
+    apisession.port = args.port
+    password = os.environ.get('CPAPI_PASSWORD') or getpass.getpass(
+        'Password for {}@{}: '.format(args.user, args.server))
+    response = apisession.login(args.server, args.user, password,
+                                args.domain)
+    try:
+        if response.status_code != 200:
+            raise SystemExit('Login failed: {}'.format(response.text))
+    except AttributeError:
+        raise SystemExit('Login failed: {}'.format(response))
+    return apisession
+
+
+def write_json(items, out):
+    """Write items as a JSON list without holding them all in memory."""
+    out.write('[')
+    for number, item in enumerate(items):
+        out.write(',\n' if number else '\n')
+        out.write(json.dumps(item))
+    out.write('\n]\n')
+
+
+def sync(args):
+    apisession = connect(args)
+    try:
+        apisession.syncobjects(full=args.full)
+        apisession.verify_obj()
+    finally:
+        apisession.logout()
+    for pluobj, entry in apisession.sync_report.items():
+        print('{}: {}/{} in {}s'.format(pluobj, entry['fetched'],
+                                        entry['total'], entry['seconds']))
+    for row in apisession.sync_calls:
+        print('{command}: {calls} calls in {seconds}s, {errors} errors, '
+              '{retries} retries, slowest {slowest}s, {received} bytes '
+              'received'.format(**row))
+    print('Local objects: {}, remote objects: {}'.format(
+        apisession.local_obj, apisession.remote_obj))
+    return 0
+
+
+def export(args):
+    from app import localdb
+
+    database = localdb.dbname(settings.config['BASEDIR'], args.server,
+                              args.domain)
+    if not os.path.exists(database):
+        raise SystemExit('No local DB {}, run sync first.'.format(database))
+    cpobjects = localdb.cplocaldb(database).export_objects(args.type)
+    if args.format == 'json':
+        write_json(cpobjects, args.output)
+        return 0
+    writer = csv.writer(args.output)
+    writer.writerow(['uid', 'name', 'type', 'ipv4', 'ipv6', 'color'])
+    for cpobject in cpobjects:
+        writer.writerow([
+            cpobject['uid'], cpobject['name'], cpobject['type'],
+            localdb.address(cpobject, 4) or '',
+            localdb.address(cpobject, 6) or '',
+            cpobject.get('color', '')
+        ])
+    return 0
+
+
+def runscript(args):
+    apisession = connect(args)
+    failed = 0
+    try:
+        response = apisession.runscript(args.target, args.script)
+        try:
+            if response.status_code != 200 or 'tasks' not in response.data:
+                raise SystemExit(response.text)
+        except AttributeError:
+            raise SystemExit(response)
+        for result in apisession.polltasks(response.data['tasks']):
+            failed += result['status'] != 'succeeded'
+            print('== {} ({})'.format(result['target'], result['status']))
+            print(result['response'])
+    finally:
+        apisession.logout()
+    return 1 if failed else 0
+
+
+def rulebase(args):
+    apisession = connect(args)
+    try:
+        layers = dict(apisession.all_layers)
+        layer_uid = layers.get(args.layer, args.layer)
+        if layer_uid not in layers.values():
+            raise SystemExit('Unknown layer {}, one of: {}'.format(
+                args.layer, ', '.join(sorted(layers))))
+        rules = apisession.showrulebase(layer_uid)
+    finally:
+        apisession.logout()
+    if args.format == 'json':
+        write_json(rules, args.output)
+        return 0
+    writer = csv.writer(args.output)
+    writer.writerow([
+        'section', 'number', 'name', 'source', 'destination', 'service',
+        'action', 'track', 'target', 'enabled'
+    ])
+    section = ''
+    for rule in rules:
+        if rule['type'] == 'section':
+            section = rule['name']
+            continue
+        names = {
+            field: ';'.join(obj[0] for obj in rule[field])
+            for field in ('source', 'destination', 'service', 'target')
+        }
+        for field in ('source', 'destination', 'service'):
+            if rule['{}-negate'.format(field)]:
+                names[field] = 'not ' + names[field]
+        writer.writerow([
+            section, rule['number'], rule['name'], names['source'],
+            names['destination'], names['service'], rule['action'],
+            rule['track'], names['target'], rule['enabled']
+        ])
+    return 0
+
+
+def chunksize(value):
+    chunk = int(value)
+    if chunk < 0:
+        raise argparse.ArgumentTypeError('must be 0 or more')
+    return chunk
+
+
+def bulkimport(args):
+    from app import importer
+
+    fmt = args.format or ('json' if args.file.endswith('.json') else 'csv')
+    if args.file == '-':
+        stream = sys.stdin
+    else:
+        stream = io.open(args.file, newline='', encoding='utf-8-sig')
+    apisession = connect(args)
+    writer = csv.DictWriter(
+        sys.stdout, ['row', 'type', 'name', 'status', 'message'])
+    writer.writeheader()
+    failed = 0
+    try:
+        with stream:
+            rows = importer.read_rows(stream, fmt)
+            for result in importer.Importer(apisession, args.chunk).run(rows):
+                failed += result['status'] != 'added'
+                writer.writerow(result)
+    finally:
+        apisession.logout()
+    return 1 if failed else 0
+
+
+def parser():
+    server = argparse.ArgumentParser(add_help=False)
+    server.add_argument('--server', required=True,
+                        help='management server address')
+    server.add_argument('--port', default='443')
+    server.add_argument('--domain')
+    login = argparse.ArgumentParser(add_help=False, parents=[server])
+    login.add_argument('--user', required=True)
+    output = argparse.ArgumentParser(add_help=False)
+    output.add_argument('--format', choices=('json', 'csv'), default='json')
+    output.add_argument('--output', '-o', type=argparse.FileType('w'),
+                        default=sys.stdout)
+
+    main = argparse.ArgumentParser(
+        prog='python -m app',
+        description='Check Point Management API tasks without the web UI.')
+    main.add_argument('--verbose', '-v', action='store_true',
+                      help='log API calls to stderr')
+    commands = main.add_subparsers(dest='command')
+    commands.required = True
+
+    command = commands.add_parser(
+        'sync', parents=[login], help='retrieve objects to the local DB')
+    command.add_argument('--full', action='store_true',
+                         help='retrieve every object instead of the changes')
+    command.set_defaults(func=sync)
+
+    command = commands.add_parser(
+        'export', parents=[server, output],
+        help='write objects of the local DB')
+    command.add_argument('--type', help='only objects of this type')
+    command.set_defaults(func=export)
+
+    command = commands.add_parser(
+        'run-script', parents=[login], help='run a script on targets')
+    command.add_argument('--target', action='append', required=True)
+    command.add_argument('--script', required=True)
+    command.set_defaults(func=runscript)
+
+    command = commands.add_parser(
+        'rulebase', parents=[login, output],
+        help='write the rules of a layer')
+    command.add_argument('layer', help='layer name or UID')
+    command.set_defaults(func=rulebase)
+
+    command = commands.add_parser(
+        'import', parents=[login],
+        help='add hosts, networks and groups from CSV or JSON')
+    command.add_argument('file', help='CSV or JSON file, - for stdin')
+    command.add_argument('--format', choices=('csv', 'json'))
+    command.add_argument(
+        '--chunk', type=chunksize, default=settings.config['IMPORT_CHUNK'],
+        help='publish every CHUNK objects, 0 publishes once')
+    command.set_defaults(func=bulkimport)
+    return main
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format='%(asctime)s %(levelname)s %(name)s - %(message)s')
+    return args.func(args)
@@ -0,0 +1,251 @@
+"""Bulk import of hosts, networks and groups from CSV or JSON.
+
+Every row is a mapping with a type (host, network or group), a name and
+depending on the type an address, a CIDR subnet or members separated by
+';'. color and comments are optional. Rows are validated against the
+local DB before anything is sent, valid rows are added concurrently in
+one session and published once, or every chunk rows.
+
+    python -m app import objects.csv --server 10.0.0.1 --user admin
+"""
+import csv
+import ipaddress
+import json
+import logging
+import sys
+import time
+
+log = logging.getLogger(__name__)
+
+TYPES = ('host', 'network', 'group')
+
+
+def read_rows(stream, fmt='csv'):
+    """Rows of a CSV or JSON text stream as dicts, CSV is read lazily."""
+    if fmt == 'json':
+        rows = json.load(stream)
+        if isinstance(rows, dict):
+            rows = rows.get('objects', [])
+        return iter(rows)
+    return csv.DictReader(stream)
+
+
+def split_members(members):
+    if isinstance(members, list):
+        return [str(member).strip() for member in members if member]
+    return [member.strip() for member in (members or '').split(';')
+            if member.strip()]
+
+
+def validate(row, dbobj, seen, colors):
+    """Error message of the fields of a row, None when they are valid. seen
+    holds the names of the valid rows read before it, group members are
+    checked afterwards by check_members."""
+    objtype = (row.get('type') or '').strip().lower()
+    name = (row.get('name') or '').strip()
+    if objtype not in TYPES:
+        return 'Unknown type "{}".'.format(row.get('type'))
+    if not name:
+        return 'No name.'
+    if name in seen:
+        return 'Duplicate name {} in the file.'.format(name)
+    if dbobj.objects_by_name(name):
+        return 'An object named {} already exists.'.format(name)
+    color = (row.get('color') or '').strip()
+    if color and color != 'black' and color not in colors:
+        return 'Unknown color {}.'.format(color)
+    address = (row.get('address') or '').strip()
+    if objtype == 'host':
+        try:
+            ipaddress.ip_address(address)
+        except ValueError:
+            return 'Invalid host address "{}".'.format(address)
+    elif objtype == 'network':
+        if '/' not in address:
+            return 'Network "{}" has no prefix length.'.format(address)
+        try:
+            network = ipaddress.ip_network(address)
+        except ValueError as e:
+            return 'Invalid network: {}.'.format(e)
+        if network.num_addresses == 1:
+            return 'Network {} is a single address, import a host.'.format(
+                address)
+    elif not split_members(row.get('members')):
+        return 'Group {} has no members.'.format(name)
+    return None
+
+
+def check_members(row, dbobj, names):
+    """Error message of a group whose members are neither in names, the
+    valid rows of the file, nor in the local DB. None when they all exist
+    or the row is no group."""
+    if row['type'].strip().lower() != 'group':
+        return None
+    for member in split_members(row.get('members')):
+        if (member not in names and not dbobj.objects_by_name(member)
+                and not dbobj.uidcheck(member)):
+            return 'Unknown member {}.'.format(member)
+    return None
+
+
+def payload(row):
+    """add-host, add-network or add-group payload of a valid row."""
+    objtype = row['type'].strip().lower()
+    data = {'name': row['name'].strip()}
+    if (row.get('color') or '').strip():
+        data['color'] = row['color'].strip()
+    if (row.get('comments') or '').strip():
+        data['comments'] = row['comments'].strip()
+    if objtype == 'host':
+        address = ipaddress.ip_address(row['address'].strip())
+        data['ipv{}-address'.format(address.version)] = str(address)
+    elif objtype == 'network':
+        network = ipaddress.ip_network(row['address'].strip())
+        data['subnet{}'.format(network.version)] = str(
+            network.network_address)
+        data['mask-length{}'.format(network.version)] = network.prefixlen
+    else:
+        data['members'] = split_members(row['members'])
+    return 'add-{}'.format(objtype), data
+
+
+def stages(rows):
+    """Split rows so every group is added after the objects of the file it
+    holds: hosts and networks first, then groups by nesting depth."""
+    depth = {}
+    groups = {row['name'].strip(): row for _, row in rows
+              if row['type'].strip().lower() == 'group'}
+
+    def level(name, path=()):
+        if name not in groups:
+            return 0
+        if name not in depth:
+            depth[name] = 1 + max(
+                [level(member, path + (name, ))
+                 for member in split_members(groups[name]['members'])
+                 if member not in path] or [0])
+        return depth[name]
+
+    ordered = {}
+    for number, row in rows:
+        ordered.setdefault(level(row['name'].strip()), []).append(
+            (number, row))
+    return [ordered[key] for key in sorted(ordered)]
+
+
+class Importer(object):
+    """Imports rows through a logged in CheckPoint_API session."""
+
+    def __init__(self, apisession, chunk=0):
+        if chunk < 0:
+            raise ValueError('chunk must be 0 or more, not {}'.format(chunk))
+        self.apisession = apisession
+        self.chunk = chunk
+
+    def run(self, rows, progress=None):
+        """Validate and import rows, yields a result per row in the order
+        they were processed."""
+        dbobj = self.apisession.dbobj
+        colors = self.apisession.all_colors
+        seen = set()
+        valid = []
+        total = 0
+        for number, row in enumerate(rows, 1):
+            total = number
+            error = validate(row, dbobj, seen, colors)
+            if error:
+                yield self.result(number, row, 'invalid', error)
+                continue
+            seen.add(row['name'].strip())
+            valid.append((number, row))
+        # Groups may come before their members, they are resolved against
+        # the whole file. Dropping a group can leave a group holding it
+        # with an unknown member, so repeat until nothing is dropped.
+        dropped = True
+        while dropped:
+            dropped = False
+            for number, row in list(valid):
+                error = check_members(row, dbobj, seen)
+                if error:
+                    yield self.result(number, row, 'invalid', error)
+                    seen.discard(row['name'].strip())
+                    valid.remove((number, row))
+                    dropped = True
+        # Chunks are published in turn, members go in the same or an
+        # earlier chunk than their groups.
+        valid = [item for stage in stages(valid) for item in stage]
+        size = self.chunk or len(valid) or 1
+        done = total - len(valid)
+        with self.apisession.lock:
+            for start in range(0, len(valid), size):
+                for result in self.importchunk(valid[start:start + size]):
+                    done += 1
+                    if progress is not None:
+                        progress(done, total)
+                    yield result
+
+    def importchunk(self, rows):
+        """Add a chunk of valid rows and publish them together."""
+        started = time.time()
+        added = []
+        failed = []
+        for stage in stages(rows):
+            for (number, row), response in zip(
+                    stage, self.apisession.imap(self.add, stage)):
+                try:
+                    if response.status_code == 200:
+                        added.append((number, row, response.data))
+                        continue
+                    message = response.data.get('message', response.text)
+                except (AttributeError, ValueError):
+                    message = str(response)
+                failed.append(self.result(number, row, 'failed', message))
+        for result in failed:
+            yield result
+        if not added:
+            return
+        response = self.apisession.publish()
+        try:
+            published = response.status_code == 200
+            message = response.text
+        except AttributeError:
+            published, message = False, str(response)
+        if published and 'task-id' in response.data:
+            task = self.apisession.waittask(response.data['task-id'])
+            published = task['status'] == 'succeeded'
+            message = task['status']
+        if not published:
+            self.apisession.discard()
+            for number, row, _ in added:
+                yield self.result(number, row, 'failed',
+                                  'Publish failed: {}'.format(message))
+            return
+        self.apisession.dbobj.insert_objects(
+            [cpobject for _, _, cpobject in added])
+        log.info('Imported {} objects in {:.2f}s'.format(
+            len(added), time.time() - started))
+        for number, row, cpobject in added:
+            yield self.result(number, row, 'added', cpobject.get('uid', ''))
+
+    def add(self, item):
+        command, data = payload(item[1])
+        return self.apisession.api_call(command, data)
+
+    @staticmethod
+    def result(number, row, status, message):
+        return {
+            'row': number,
+            'type': row.get('type'),
+            'name': row.get('name'),
+            'status': status,
+            'message': message
+        }
+
+
+def main(argv=None):
+    from app import cli
+    return cli.main(['import'] + list(sys.argv[1:] if argv is None else argv))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
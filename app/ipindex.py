@@ -0,0 +1,91 @@
+import bisect
+import collections
+import ipaddress
+import threading
+import weakref
+
+_indexes = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def addressindex(dbobj):
+    """AddressIndex of a local DB, rebuilt after the DB has changed."""
+    with _lock:
+        cached = _indexes.get(dbobj)
+    if cached is not None and cached.generation == dbobj.generation:
+        return cached
+    index = AddressIndex(dbobj)
+    with _lock:
+        _indexes[dbobj] = index
+    return index
+
+
+class AddressIndex(object):
+    """Interval index over the addresses and subnets of the local DB.
+
+    CIDRs are either nested or disjoint, so the objects overlapping a
+    prefix are its supernets, found by hashing every shorter prefix, and
+    the objects starting inside it, found by bisecting the sorted starts.
+    Groups are resolved transitively through the members table.
+    """
+
+    def __init__(self, dbobj):
+        self.generation = dbobj.generation
+        self.objects = {}
+        self.networks = collections.defaultdict(set)
+        self.starts = {4: [], 6: []}
+        for row in dbobj.addressed_objects():
+            self.objects[row[0]] = (row[1], row[2])
+            for value in (row[3], row[4]):
+                try:
+                    network = ipaddress.ip_network(value, strict=False)
+                except (TypeError, ValueError):
+                    continue
+                self.networks[network].add(row[0])
+        for network in self.networks:
+            self.starts[network.version].append(
+                (int(network.network_address), network))
+        for starts in self.starts.values():
+            starts.sort(key=lambda start: start[0])
+        self.keys = {
+            version: [start[0] for start in starts]
+            for version, starts in self.starts.items()
+        }
+        self.parents = collections.defaultdict(set)
+        for row in dbobj.memberships():
+            self.parents[row[1]].add(row[0])
+        self.groupcache = {}
+
+    def overlapping(self, network):
+        """UIDs of objects whose address or subnet overlaps network."""
+        uids = set()
+        for prefixlen in range(network.prefixlen + 1):
+            uids.update(
+                self.networks.get(network.supernet(new_prefix=prefixlen), ()))
+        keys = self.keys[network.version]
+        low = bisect.bisect_left(keys, int(network.network_address))
+        high = bisect.bisect_right(keys, int(network.broadcast_address))
+        for start, found in self.starts[network.version][low:high]:
+            uids.update(self.networks[found])
+        return uids
+
+    def groups(self, uid):
+        """Every group holding uid, directly or through nested groups."""
+        if uid not in self.groupcache:
+            found = set()
+            pending = [uid]
+            while pending:
+                for parent in self.parents.get(pending.pop(), ()):
+                    if parent not in found:
+                        found.add(parent)
+                        pending.append(parent)
+            self.groupcache[uid] = frozenset(found)
+        return self.groupcache[uid]
+
+    def matching(self, network):
+        """(direct, via group) UIDs covering or inside network."""
+        direct = self.overlapping(network)
+        groups = set()
+        for uid in direct:
+            groups.update(self.groups(uid))
+        return direct, groups - direct
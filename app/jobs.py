@@ -0,0 +1,301 @@
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+from app import settings
+
+log = logging.getLogger(__name__)
+
+# Kinds of job and the generator functions running them, see handler().
+HANDLERS = {}
+# Kinds whose interrupted jobs can safely run again after a restart.
+RESTARTABLE = set()
+# Seconds between progress writes to the job DB.
+PERSIST_INTERVAL = 1
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobError(Exception):
+    """A job failed, the message is shown to the user."""
+
+
+def handler(kind, restartable=False):
+    """Register func(job, **params) as the generator running jobs of kind,
+    everything it yields is kept as a result of the job."""
+
+    def register(func):
+        HANDLERS[kind] = func
+        if restartable:
+            RESTARTABLE.add(kind)
+        return func
+
+    return register
+
+
+class Job(object):
+    """A queued operation, its progress and the results it produced."""
+
+    def __init__(self, store, job_id, kind, owner, params, status='queued',
+                 done=0, total=None, message='', results=None, error=None,
+                 created=None, started=None, finished=None):
+        self.store = store
+        self.id = job_id
+        self.kind = kind
+        self.owner = owner
+        self.params = params
+        self.status = status
+        self.done = done
+        self.total = total
+        self.message = message
+        self.results = results or []
+        self.error = error
+        self.created = created or time.time()
+        self.started = started
+        self.finished = finished
+        self.cancelled = False
+        self.persisted = 0
+        self.lock = threading.Lock()
+
+    def progress(self, done, total=None, message=None):
+        """Record progress, raises JobCancelled once a cancel was asked for
+        so long running work stops at the next report."""
+        with self.lock:
+            self.done = done
+            if total is not None:
+                self.total = total
+            if message is not None:
+                self.message = message
+        self.persist()
+        if self.cancelled:
+            raise JobCancelled()
+
+    def persist(self):
+        """Write the job to the store at most every PERSIST_INTERVAL."""
+        with self.lock:
+            if time.time() - self.persisted < PERSIST_INTERVAL:
+                return
+            self.persisted = time.time()
+        self.store.save(self)
+
+    def run(self):
+        self.status = 'running'
+        self.started = time.time()
+        self.store.save(self)
+        try:
+            for result in HANDLERS[self.kind](self, **self.params):
+                with self.lock:
+                    self.results.append(result)
+                self.persist()
+                if self.cancelled:
+                    raise JobCancelled()
+            self.status = 'finished'
+        except JobCancelled:
+            self.status = 'cancelled'
+        except JobError as e:
+            log.warning('Job {} ({}) failed: {}'.format(
+                self.id, self.kind, e))
+            self.status = 'failed'
+            self.error = str(e)
+        except Exception as e:
+            log.exception('Job {} ({}) failed'.format(
+                self.id, self.kind))
+            self.status = 'failed'
+            self.error = str(e)
+        self.finished = time.time()
+        self.store.save(self)
+        log.info('Job {} ({}) {} in {:.2f}s'.format(
+            self.id, self.kind, self.status, self.finished - self.started))
+
+    @property
+    def active(self):
+        return self.status in ('queued', 'running')
+
+    def as_dict(self, since=0):
+        """Job state with the results produced after the first since."""
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'done': self.done,
+            'total': self.total,
+            'message': self.message,
+            'error': self.error,
+            'results': self.results[since:],
+            'count': len(self.results)
+        }
+
+
+class JobStore(object):
+    """Job records in SQLite so queued work survives a restart."""
+
+    def __init__(self, database):
+        self.dbconn = sqlite3.connect(database, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.dbconn:
+            self.dbconn.execute('PRAGMA journal_mode=WAL;')
+            self.dbconn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs (id text PRIMARY KEY, '
+                'kind text, owner text, params text, status text, '
+                'done integer, total integer, message text, results text, '
+                'error text, created real, started real, finished real);')
+            self.dbconn.execute(
+                'CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, '
+                'status);')
+
+    def save(self, job):
+        with job.lock:
+            row = (job.id, job.kind, job.owner, json.dumps(job.params),
+                   job.status, job.done, job.total, job.message,
+                   json.dumps(job.results), job.error, job.created,
+                   job.started, job.finished)
+        with self.lock, self.dbconn:
+            self.dbconn.execute(
+                'INSERT OR REPLACE INTO jobs VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);', row)
+
+    def load(self, job_id):
+        with self.lock:
+            row = self.dbconn.execute('SELECT * FROM jobs WHERE id=?;',
+                                      (job_id, )).fetchone()
+        return self.job(row) if row else None
+
+    def unfinished(self, owner):
+        with self.lock:
+            rows = self.dbconn.execute(
+                'SELECT * FROM jobs WHERE owner=? AND status IN '
+                "('queued', 'running') ORDER BY created;",
+                (owner, )).fetchall()
+        return [self.job(row) for row in rows]
+
+    def purge(self, before):
+        """Forget jobs that finished before a posix time."""
+        with self.lock, self.dbconn:
+            self.dbconn.execute(
+                'DELETE FROM jobs WHERE finished IS NOT NULL AND '
+                'finished < ?;', (before, ))
+
+    def job(self, row):
+        return Job(self, row[0], row[1], row[2], json.loads(row[3]), row[4],
+                   row[5], row[6], row[7], json.loads(row[8]), row[9],
+                   row[10], row[11], row[12])
+
+
+class JobQueue(object):
+    """Worker threads running jobs in submission order.
+
+    Jobs of the current process are kept in memory for polling, their
+    records are written through to the JobStore. Workers start with the
+    first job so importing the module has no side effects."""
+
+    def __init__(self, database, workers=2, keep=86400):
+        self.database = database
+        self.workers = workers
+        self.keep = keep
+        self.store = None
+        self.jobs = {}
+        self.pending = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.store is None:
+                self.store = JobStore(self.database)
+                self.store.purge(time.time() - self.keep)
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def work(self):
+        while True:
+            job = self.pending.get()
+            if job.status == 'queued':
+                job.run()
+            self.pending.task_done()
+
+    def submit(self, kind, owner, unique=False, **params):
+        """Queue a job and return it. With unique an active job of the same
+        kind, owner and params is returned instead of a new one."""
+        self.start()
+        with self.lock:
+            expired = time.time() - self.keep
+            for job_id in [job_id for job_id, job in self.jobs.items()
+                           if job.finished and job.finished < expired]:
+                del self.jobs[job_id]
+            if unique:
+                for job in self.jobs.values():
+                    if (job.active and job.kind == kind
+                            and job.owner == owner and job.params == params):
+                        return job
+            job = Job(self.store, uuid.uuid4().hex, kind, owner, params)
+            self.jobs[job.id] = job
+        self.store.save(job)
+        self.pending.put(job)
+        return job
+
+    def get(self, job_id, owner=None):
+        self.start()
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            job = self.store.load(job_id)
+        if job is None or (owner is not None and job.owner != owner):
+            return None
+        return job
+
+    def busy(self, owner):
+        """Whether an owner has jobs queued or running."""
+        with self.lock:
+            return any(job.active and job.owner == owner
+                       for job in self.jobs.values())
+
+    def cancel(self, job_id, owner=None):
+        """Cancel a queued job at once, a running one at its next progress
+        report or result."""
+        job = self.get(job_id, owner)
+        if job is None or not job.active:
+            return job
+        job.cancelled = True
+        if job.status == 'queued':
+            job.status = 'cancelled'
+            job.finished = time.time()
+            self.store.save(job)
+        return job
+
+    def resume(self, owner):
+        """Queue the unfinished jobs an owner had before a restart. Jobs
+        that were already running only run again if their kind is
+        restartable, the others are marked as interrupted."""
+        self.start()
+        resumed = []
+        for job in self.store.unfinished(owner):
+            with self.lock:
+                if job.id in self.jobs:
+                    continue
+                self.jobs[job.id] = job
+            if job.status == 'running' and job.kind not in RESTARTABLE:
+                job.status = 'failed'
+                job.error = 'Interrupted by a restart.'
+                job.finished = time.time()
+                self.store.save(job)
+                continue
+            job.status = 'queued'
+            self.store.save(job)
+            self.pending.put(job)
+            resumed.append(job)
+        if resumed:
+            log.info('Resumed {} jobs of {}'.format(
+                len(resumed), owner))
+        return resumed
+
+
+jobqueue = JobQueue('{}jobs.db'.format(settings.config['BASEDIR']),
+                    settings.config['JOB_WORKERS'], settings.config['JOB_KEEP'])
@@ -1,37 +1,226 @@
+import json
 import sqlite3
+import threading
+import time
+import zlib
+
+from app.profiling import ProfiledConnection
+
+
+def dbname(basedir, ipaddress, domain=None):
+    """Path of the local DB of a management server or domain."""
+    if domain:
+        return '{}{}_{}.db'.format(basedir, ipaddress, domain)
+    return '{}{}.db'.format(basedir, ipaddress)
+
+
+def group_members(cpobject):
+    """(group uid, member uid) pairs of a group object."""
+    return [(cpobject['uid'], member['uid'] if isinstance(member, dict) else
+             member) for member in cpobject.get('members', [])]
+
+
+def migrate_members(dbconn):
+    """Group membership table, filled from the stored groups."""
+    dbconn.execute('CREATE TABLE members (group_uid text, member_uid text, '
+                   'PRIMARY KEY (group_uid, member_uid));')
+    dbconn.execute('CREATE INDEX members_member ON members (member_uid);')
+    groups = dbconn.execute(
+        "SELECT raw FROM objects WHERE type='group' AND raw IS NOT NULL;")
+    for row in groups.fetchall():
+        dbconn.executemany(
+            'INSERT OR IGNORE INTO members VALUES (?, ?);',
+            group_members(json.loads(zlib.decompress(row[0]).decode())))
+
+
+# Schema migrations, PRAGMA user_version holds how many have been applied.
+# Plain SQL runs as a script, a function is called with the connection.
+MIGRATIONS = [
+    # 1: Real UID primary key, indexes and per object detail columns. The
+    # original table was created with a misspelled PRIMARY KEY so duplicate
+    # rows are collapsed while copying.
+    """
+    CREATE TABLE IF NOT EXISTS objects (uid text, name text, type text);
+    CREATE TABLE objects_v1 (
+        uid text PRIMARY KEY,
+        name text,
+        type text,
+        ipv4 text,
+        ipv6 text,
+        color text,
+        last_modify integer,
+        raw blob
+    );
+    INSERT OR REPLACE INTO objects_v1 (uid, name, type)
+        SELECT uid, name, type FROM objects;
+    DROP TABLE objects;
+    ALTER TABLE objects_v1 RENAME TO objects;
+    CREATE INDEX objects_type ON objects (type);
+    CREATE INDEX objects_name ON objects (name);
+    """,
+    # 2: Incremental sync high-water mark and a record of deleted objects.
+    """
+    CREATE TABLE sync_state (name text PRIMARY KEY, value text);
+    CREATE TABLE deleted_objects (
+        uid text,
+        name text,
+        type text,
+        deleted integer
+    );
+    CREATE INDEX deleted_objects_deleted ON deleted_objects (deleted);
+    """,
+    # 3: Filtered rulebases cached per layer and domain.
+    """
+    CREATE TABLE rulebases (
+        layer text,
+        domain text,
+        revision text,
+        rules blob,
+        updated integer,
+        PRIMARY KEY (layer, domain)
+    );
+    """,
+    # 4: Group members for transitive address lookups.
+    migrate_members,
+    # 5: Cached rules now carry their UID, drop those stored without it.
+    """
+    DELETE FROM rulebases;
+    """,
+]
 
 
 def createdb(dbname):
-    open(dbname, 'a')
-    dbobj = cplocaldb(dbname)
-    dbobj.cursor.execute(
-        'CREATE TABLE objects (uid text PRIMAR KEY, name text, type text);')
+    cplocaldb(dbname)
+
+
+def address(cpobject, version):
+    """Host address or network CIDR of an object for an IP version."""
+    if 'ipv{}-address'.format(version) in cpobject:
+        return cpobject['ipv{}-address'.format(version)]
+    if 'subnet{}'.format(version) in cpobject:
+        return '{}/{}'.format(cpobject['subnet{}'.format(version)],
+                              cpobject['mask-length{}'.format(version)])
+    return None
+
+
+def object_row(cpobject):
+    """Column values of an object, the full object is kept compressed."""
+    try:
+        last_modify = cpobject['meta-info']['last-modify-time']['posix']
+    except KeyError:
+        last_modify = None
+    return (cpobject['uid'], cpobject['name'], cpobject['type'],
+            address(cpobject, 4), address(cpobject, 6),
+            cpobject.get('color'), last_modify,
+            sqlite3.Binary(zlib.compress(json.dumps(cpobject).encode())))
 
 
 class cplocaldb(object):
     def __init__(self, database):
         self.database = database
-        self.dbconn = sqlite3.connect(database, check_same_thread=False)
-        self.dbconn.row_factory = sqlite3.Row
-        self.cursor = self.dbconn.cursor()
+        # Every thread reads through its own connection, writers are
+        # serialized by the lock as SQLite allows a single writer anyway.
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # Bumped on every write so derived indexes know to rebuild.
+        self.generation = 0
+        self.migrate()
+
+    @property
+    def dbconn(self):
+        """Connection of the calling thread, opened on first use."""
+        dbconn = getattr(self.local, 'dbconn', None)
+        if dbconn is None:
+            dbconn = sqlite3.connect(self.database,
+                                     factory=ProfiledConnection)
+            dbconn.row_factory = sqlite3.Row
+            # WAL lets the views read while a sync writes, the local DB is a
+            # cache of the management server so NORMAL sync is durable
+            # enough.
+            dbconn.execute('PRAGMA journal_mode=WAL;')
+            dbconn.execute('PRAGMA synchronous=NORMAL;')
+            dbconn.execute('PRAGMA cache_size=-20000;')
+            self.local.dbconn = dbconn
+        return dbconn
+
+    def migrate(self):
+        """Upgrade the database in place to the latest schema."""
+        version = self.dbconn.execute('PRAGMA user_version;').fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:],
+                                           version + 1):
+            if callable(migration):
+                with self.dbconn:
+                    migration(self.dbconn)
+                    self.dbconn.execute(
+                        'PRAGMA user_version={};'.format(number))
+            else:
+                self.dbconn.executescript(
+                    'BEGIN;{}PRAGMA user_version={};COMMIT;'.format(
+                        migration, number))
+
+    def insert_objects(self, cpobjects):
+        """Upsert objects and their group members in a single
+        transaction."""
+        cpobjects = list(cpobjects)
+        groups = [(cpobject['uid'], ) for cpobject in cpobjects
+                  if cpobject['type'] == 'group']
+        with self.lock, self.dbconn:
+            self.dbconn.executemany(
+                'INSERT OR REPLACE INTO objects (uid, name, type, ipv4, '
+                'ipv6, color, last_modify, raw) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?);',
+                (object_row(cpobject) for cpobject in cpobjects))
+            self.dbconn.executemany('DELETE FROM members WHERE group_uid=?;',
+                                    groups)
+            self.dbconn.executemany(
+                'INSERT OR IGNORE INTO members VALUES (?, ?);',
+                (pair for cpobject in cpobjects
+                 if cpobject['type'] == 'group'
+                 for pair in group_members(cpobject)))
+            self.generation += 1
 
     def insert_object(self, cpobject):
-        self.cursor.execute(
-            'INSERT INTO objects VALUES("{}", "{}", "{}")'.format(
-                cpobject['uid'], cpobject['name'], cpobject['type']))
+        self.insert_objects([cpobject])
 
     def delete_object(self, uid):
-        self.cursor.execute('DELETE FROM objects WHERE uid="{}";'.format(uid))
+        self.delete_objects([uid])
+
+    def delete_objects(self, uids):
+        """Delete objects by UID in a single transaction and record them in
+        deleted_objects."""
+        uids = [(uid, ) for uid in uids]
+        with self.lock, self.dbconn:
+            self.dbconn.executemany(
+                'INSERT INTO deleted_objects (uid, name, type, deleted) '
+                'SELECT uid, name, type, {} FROM objects WHERE uid=?;'.format(
+                    int(time.time())), uids)
+            self.dbconn.executemany('DELETE FROM objects WHERE uid=?;', uids)
+            self.dbconn.executemany('DELETE FROM members WHERE group_uid=?;',
+                                    uids)
+            self.generation += 1
+
+    def get_state(self, name):
+        cursor = self.dbconn.execute(
+            'SELECT value FROM sync_state WHERE name=?;', (name, ))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def set_state(self, name, value):
+        with self.lock, self.dbconn:
+            self.dbconn.execute(
+                'INSERT OR REPLACE INTO sync_state (name, value) '
+                'VALUES (?, ?);', (name, value))
 
     def object_counter(self):
-        self.cursor.execute('SELECT (select count() from objects) as count;')
-        objcount = self.cursor.fetchall()
+        cursor = self.dbconn.execute(
+            'SELECT (select count() from objects) as count;')
+        objcount = cursor.fetchall()
         return objcount[0][0]
 
     def uidcheck(self, uid):
-        self.cursor.execute(
-            'SELECT uid FROM objects WHERE uid="{}";'.format(uid))
-        objfind = self.cursor.fetchall()
+        cursor = self.dbconn.execute('SELECT uid FROM objects WHERE uid=?;',
+                                     (uid, ))
+        objfind = cursor.fetchall()
         for obj in objfind:
             if obj[0] == None:
                 return False
@@ -39,30 +228,126 @@ class cplocaldb(object):
                 return True
 
     def local_uids(self):
-        self.cursor.execute('SELECT uid, type FROM objects;')
-        all_uid = self.cursor.fetchall()
-        return [uid[0] for uid in all_uid]
-
-    def allobjects(self):
-        nettypes = ['host', 'network', 'group']
-        servtypes = ['service-tcp', 'service-udp', 'service-group']
-        all_objects = {
-            'networkobjects': [],
-            'serviceobjects': [],
-            'targets': []
-        }
-        self.cursor.execute('SELECT * FROM objects')
-        dbresp = self.cursor.fetchall()
-        for row in dbresp:
-            if row[2] in nettypes:
-                all_objects['networkobjects'].append(row)
-            elif row[2] in servtypes:
-                all_objects['serviceobjects'].append(row)
+        cursor = self.dbconn.execute('SELECT uid FROM objects;')
+        return set(row[0] for row in cursor.fetchall())
+
+    def get_object(self, uid):
+        """Full stored object by UID, None if unknown or never fetched."""
+        cursor = self.dbconn.execute('SELECT raw FROM objects WHERE uid=?;',
+                                     (uid, ))
+        row = cursor.fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(zlib.decompress(row[0]).decode())
+
+    def get_objects(self, uids):
+        """Full stored objects by UID, objects never fetched are left out."""
+        uids = list(uids)
+        found = {}
+        # Stay below the SQLite bound variable limit.
+        for index in range(0, len(uids), 500):
+            chunk = uids[index:index + 500]
+            cursor = self.dbconn.execute(
+                'SELECT uid, raw FROM objects WHERE raw IS NOT NULL AND uid '
+                'IN ({});'.format(', '.join('?' * len(chunk))), chunk)
+            for row in cursor.fetchall():
+                found[row[0]] = json.loads(zlib.decompress(row[1]).decode())
+        return found
+
+    def addressed_objects(self):
+        cursor = self.dbconn.execute(
+            'SELECT uid, name, type, ipv4, ipv6 FROM objects WHERE ipv4 IS '
+            'NOT NULL OR ipv6 IS NOT NULL;')
+        return cursor.fetchall()
+
+    def memberships(self):
+        cursor = self.dbconn.execute(
+            'SELECT group_uid, member_uid FROM members;')
+        return cursor.fetchall()
+
+    def object_names(self, uids):
+        """(name, type) by UID for the given UIDs."""
+        uids = list(uids)
+        found = {}
+        for index in range(0, len(uids), 500):
+            chunk = uids[index:index + 500]
+            cursor = self.dbconn.execute(
+                'SELECT uid, name, type FROM objects WHERE uid IN '
+                '({});'.format(', '.join('?' * len(chunk))), chunk)
+            for row in cursor.fetchall():
+                found[row[0]] = (row[1], row[2])
+        return found
+
+    def load_rulebase(self, layer, domain):
+        """Cached (revision, rules) of a layer, None if never stored."""
+        cursor = self.dbconn.execute(
+            'SELECT revision, rules FROM rulebases WHERE layer=? AND '
+            'domain=?;', (layer, domain))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return (row[0], json.loads(zlib.decompress(row[1]).decode()))
+
+    def save_rulebase(self, layer, domain, revision, rules):
+        blob = sqlite3.Binary(zlib.compress(json.dumps(rules).encode()))
+        with self.lock, self.dbconn:
+            self.dbconn.execute(
+                'INSERT OR REPLACE INTO rulebases (layer, domain, revision, '
+                'rules, updated) VALUES (?, ?, ?, ?, ?);',
+                (layer, domain, revision, blob, int(time.time())))
+
+    def delete_rulebase(self, layer, domain):
+        with self.lock, self.dbconn:
+            self.dbconn.execute(
+                'DELETE FROM rulebases WHERE layer=? AND domain=?;',
+                (layer, domain))
+
+    def export_objects(self, cptype=None):
+        """Stored objects ordered by type and name, the full object when it
+        was fetched."""
+        if cptype:
+            cursor = self.dbconn.execute(
+                'SELECT uid, name, type, raw FROM objects WHERE type=? '
+                'ORDER BY name;', (cptype, ))
+        else:
+            cursor = self.dbconn.execute(
+                'SELECT uid, name, type, raw FROM objects ORDER BY type, '
+                'name;')
+        for row in cursor:
+            if row[3] is None:
+                yield {'uid': row[0], 'name': row[1], 'type': row[2]}
             else:
-                all_objects['networkobjects'].append(row)
-                if 'host' in row[2].lower():
-                    # Check Point Management Object
-                    pass
-                else:
-                    all_objects['targets'].append(row)
-        return all_objects
+                yield json.loads(zlib.decompress(row[3]).decode())
+
+    def objects_by_type(self, cptype):
+        cursor = self.dbconn.execute(
+            'SELECT uid, name, type FROM objects WHERE type=? ORDER BY name;',
+            (cptype, ))
+        return cursor.fetchall()
+
+    def objects_by_name(self, name):
+        cursor = self.dbconn.execute(
+            'SELECT uid, name, type FROM objects WHERE name=?;', (name, ))
+        return cursor.fetchall()
+
+    def search_objects(self, kind, term, offset, limit):
+        """Page of (uid, name, type) for the lazy object pickers. kind is
+        network, service or target, targets are objects of the remaining
+        types without host in their type name."""
+        servtypes = ('service-tcp', 'service-udp', 'service-group')
+        nettypes = ('host', 'network', 'group')
+        if kind == 'service':
+            where = 'type IN (?, ?, ?)'
+            params = list(servtypes)
+        elif kind == 'target':
+            where = ('type NOT IN (?, ?, ?, ?, ?, ?) AND '
+                     "lower(type) NOT LIKE '%host%'")
+            params = list(nettypes + servtypes)
+        else:
+            where = 'type NOT IN (?, ?, ?)'
+            params = list(servtypes)
+        cursor = self.dbconn.execute(
+            'SELECT uid, name, type FROM objects WHERE {} AND name LIKE ? '
+            'ORDER BY name LIMIT ? OFFSET ?;'.format(where),
+            params + ['%{}%'.format(term), limit, offset])
+        return cursor.fetchall()
@@ -0,0 +1,167 @@
+"""Counters and latency histograms of the Management API calls.
+
+metrics collects every call of the process and is rendered in the
+Prometheus text format on /metrics. A sync keeps its own Metrics for the
+summary logged when it ends.
+"""
+import collections
+import threading
+
+# Upper bounds in seconds of the call latency histogram buckets.
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Metrics(object):
+    """API call counters per command."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.errors = collections.Counter()
+        self.retries = collections.Counter()
+        self.sent = collections.Counter()
+        self.received = collections.Counter()
+        self.seconds = collections.Counter()
+        self.waited = collections.Counter()
+        self.slowest = {}
+        self.buckets = collections.defaultdict(lambda: [0] * len(BUCKETS))
+        self.inflight = collections.Counter()
+        self.handshakes = 0
+
+    def started(self, command):
+        with self.lock:
+            self.inflight[command] += 1
+
+    def finished(self, command, status, seconds, waited=0, sent=0,
+                 received=0):
+        """Account for a finished call. status is the HTTP status code or
+        'error' when no reply came, waited the seconds until the reply
+        headers arrived."""
+        with self.lock:
+            self.inflight[command] -= 1
+            self.calls[command, str(status)] += 1
+            if status == 'error':
+                self.errors[command, 'connection'] += 1
+            elif status >= 400:
+                self.errors[command, 'status'] += 1
+            self.sent[command] += sent
+            self.received[command] += received
+            self.seconds[command] += seconds
+            self.waited[command] += waited
+            self.slowest[command] = max(self.slowest.get(command, 0),
+                                        seconds)
+            buckets = self.buckets[command]
+            for number, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    buckets[number] += 1
+
+    def retried(self, command, reason, count=1):
+        """Count calls sent again, after a connection or gateway error or
+        after logging in again."""
+        if count:
+            with self.lock:
+                self.retries[command, reason] += count
+
+    def handshake(self):
+        with self.lock:
+            self.handshakes += 1
+
+    def summary(self):
+        """Calls, failures, timing and bytes per command, slowest first."""
+        with self.lock:
+            commands = set(command for command, _ in self.calls)
+            rows = [{
+                'command': command,
+                'calls': self.count(command),
+                'errors': sum(count for (name, _), count in
+                              self.errors.items() if name == command),
+                'retries': sum(count for (name, _), count in
+                               self.retries.items() if name == command),
+                'seconds': round(self.seconds[command], 2),
+                'waited': round(self.waited[command], 2),
+                'slowest': round(self.slowest[command], 3),
+                'sent': self.sent[command],
+                'received': self.received[command]
+            } for command in commands]
+        for row in rows:
+            row['mean'] = round(row['seconds'] / row['calls'], 3)
+        return sorted(rows, key=lambda row: row['seconds'], reverse=True)
+
+    def count(self, command):
+        return sum(count for (name, _), count in self.calls.items()
+                   if name == command)
+
+    def render(self, gauges=None):
+        """Prometheus text exposition of the counters, gauges adds
+        name: (help, value) pairs."""
+        lines = []
+
+        def family(name, kind, text, samples):
+            lines.append('# HELP {} {}'.format(name, text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(name, labelset(labels), value))
+
+        with self.lock:
+            family('cpapi_api_calls_total', 'counter',
+                   'Management API calls by command and HTTP status.',
+                   [((('command', command), ('code', code)), count)
+                    for (command, code), count in sorted(self.calls.items())])
+            family('cpapi_api_errors_total', 'counter',
+                   'Calls without a reply or with an error status.',
+                   [((('command', command), ('reason', reason)), count)
+                    for (command, reason), count in
+                    sorted(self.errors.items())])
+            family('cpapi_api_retries_total', 'counter',
+                   'Calls sent again after an error or a new login.',
+                   [((('command', command), ('reason', reason)), count)
+                    for (command, reason), count in
+                    sorted(self.retries.items())])
+            family('cpapi_api_request_bytes_total', 'counter',
+                   'Bytes of request bodies sent.',
+                   [((('command', command), ), count)
+                    for command, count in sorted(self.sent.items())])
+            family('cpapi_api_response_bytes_total', 'counter',
+                   'Bytes of response bodies received.',
+                   [((('command', command), ), count)
+                    for command, count in sorted(self.received.items())])
+            family('cpapi_api_wait_seconds_total', 'counter',
+                   'Seconds until the reply headers arrived, server and '
+                   'network time.',
+                   [((('command', command), ), round(seconds, 6))
+                    for command, seconds in sorted(self.waited.items())])
+            family('cpapi_api_call_seconds', 'histogram',
+                   'Seconds per API call including the reply body.', [])
+            for command, buckets in sorted(self.buckets.items()):
+                count = self.count(command)
+                for bound, value in zip(BUCKETS + ('+Inf', ),
+                                        buckets + [count]):
+                    lines.append('cpapi_api_call_seconds_bucket{} {}'.format(
+                        labelset((('command', command), ('le', bound))),
+                        value))
+                labels = labelset((('command', command), ))
+                lines.append('cpapi_api_call_seconds_sum{} {}'.format(
+                    labels, round(self.seconds[command], 6)))
+                lines.append('cpapi_api_call_seconds_count{} {}'.format(
+                    labels, count))
+            family('cpapi_api_calls_in_flight', 'gauge',
+                   'API calls waiting for their reply.',
+                   [((('command', command), ), count)
+                    for command, count in sorted(self.inflight.items())])
+            family('cpapi_tls_handshakes_total', 'counter',
+                   'TLS connections opened to management servers.',
+                   [((), self.handshakes)])
+        for name, (text, value) in sorted((gauges or {}).items()):
+            family(name, 'gauge', text, [((), value)])
+        return '\n'.join(lines) + '\n'
+
+
+def labelset(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"')) for name, value in labels))
+
+
+metrics = Metrics()
@@ -0,0 +1,61 @@
+import threading
+
+from app import settings
+
+
+class PageSizer(object):
+    """Page size of each show command, adapted to its recent pages.
+
+    The time and bytes per item are averaged per key, usually server and
+    command, and the next page size is what fits in PAGE_SECONDS and
+    PAGE_BYTES, between PAGE_MIN and PAGE_MAX and growing at most fourfold
+    a page. A server returning fewer items than asked for while more remain
+    caps the key at that count.
+    """
+
+    def __init__(self):
+        self.sizes = {}
+        self.costs = {}
+        self.caps = {}
+        self.lock = threading.Lock()
+
+    def size(self, key):
+        """Items to ask for in the next page of key."""
+        with self.lock:
+            return self.bounded(key, self.sizes.get(
+                key, settings.config['PAGE_MIN']))
+
+    def record(self, key, asked, returned, seconds, size=None, more=False):
+        """Account for a page of returned out of asked items that took
+        seconds and size bytes, size is None for streamed pages. more tells
+        whether items remain past it. Returns the next page size."""
+        with self.lock:
+            if more and 0 < returned < asked:
+                self.caps[key] = returned
+            current = self.sizes.get(key, settings.config['PAGE_MIN'])
+            if not returned:
+                return self.bounded(key, current)
+            each = seconds / returned
+            each_bytes = float(size) / returned if size else None
+            if key in self.costs:
+                before, before_bytes = self.costs[key]
+                each = (before + each) / 2
+                if each_bytes is None:
+                    each_bytes = before_bytes
+                elif before_bytes is not None:
+                    each_bytes = (before_bytes + each_bytes) / 2
+            self.costs[key] = (each, each_bytes)
+            fits = settings.config['PAGE_SECONDS'] / max(each, 1e-6)
+            if each_bytes:
+                fits = min(fits, settings.config['PAGE_BYTES'] / each_bytes)
+            self.sizes[key] = self.bounded(key, int(min(fits, current * 4)))
+            return self.sizes[key]
+
+    def bounded(self, key, size):
+        size = max(settings.config['PAGE_MIN'],
+                   min(size, settings.config['PAGE_MAX']))
+        return min(size, self.caps.get(key, size))
+
+
+# Shared by every session so page sizes carry over between logins.
+pagesizer = PageSizer()
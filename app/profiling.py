@@ -0,0 +1,225 @@
+"""Opt-in profiling of web requests, enabled by the PROFILE setting.
+
+Every request collects a tree of spans: the API calls, local DB queries
+and template renders made while it ran, including those made on worker
+threads started through carry(). The totals per kind are sent in a
+Server-Timing header, the tree of requests slower than PROFILE_SLOW
+seconds is logged and a PROFILE_SAMPLE fraction of requests is run under
+cProfile with the stats written to BASEDIR/profiles.
+"""
+import contextlib
+import cProfile
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from app import settings
+
+log = logging.getLogger(__name__)
+
+# Span names summed up in the Server-Timing header.
+KINDS = ('api', 'db', 'render')
+
+_local = threading.local()
+# cProfile can only profile one request at a time.
+_sampling = threading.Lock()
+
+
+class Span(object):
+    """A timed piece of work and the spans started inside it."""
+
+    def __init__(self, name, detail='', parent=None):
+        self.name = name
+        self.detail = detail
+        self.parent = parent
+        self.children = []
+        self.started = time.time()
+        self.seconds = None
+
+    def finish(self):
+        self.seconds = time.time() - self.started
+
+    def walk(self, depth=0):
+        """(depth, span) of this span and its descendants in start order."""
+        yield depth, self
+        for child in sorted(self.children, key=lambda span: span.started):
+            for item in child.walk(depth + 1):
+                yield item
+
+    def totals(self):
+        """Seconds and count of the spans of each kind below this one."""
+        totals = dict((kind, [0.0, 0]) for kind in KINDS)
+        for _, span in self.walk():
+            if span is not self and span.name in totals:
+                totals[span.name][0] += span.seconds or 0
+                totals[span.name][1] += 1
+        return totals
+
+
+def current():
+    """Innermost span of the calling thread, None when not profiling."""
+    return getattr(_local, 'span', None)
+
+
+def enter(name, detail=''):
+    """Start a span below the current one and make it current."""
+    parent = current()
+    if parent is None:
+        return None
+    child = Span(name, detail, parent)
+    parent.children.append(child)
+    _local.span = child
+    return child
+
+
+def leave(child):
+    """Finish a span started by enter, its parent is current again."""
+    if child is not None:
+        child.finish()
+        _local.span = child.parent
+
+
+@contextlib.contextmanager
+def span(name, detail=''):
+    """Time the enclosed block as a child of the current span."""
+    child = enter(name, detail)
+    try:
+        yield child
+    finally:
+        leave(child)
+
+
+def carry(func):
+    """func running under the current span when called on another thread,
+    for work handed to thread pools."""
+    parent = current()
+    if parent is None:
+        return func
+
+    def run(*args, **kwargs):
+        before = current()
+        _local.span = parent
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.span = before
+
+    return run
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """sqlite3 connection timing its statements as db spans."""
+
+    def execute(self, sql, *args):
+        if current() is None:
+            return super().execute(sql, *args)
+        with span('db', sql[:80]):
+            return super().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        if current() is None:
+            return super().executemany(sql, *args)
+        with span('db', sql[:80]):
+            return super().executemany(sql, *args)
+
+    def executescript(self, sql):
+        if current() is None:
+            return super().executescript(sql)
+        with span('db', 'script'):
+            return super().executescript(sql)
+
+
+def servertiming(root):
+    """Server-Timing header value of a finished request span."""
+    entries = [
+        '{};dur={:.1f};desc="{} calls"'.format(kind, seconds * 1000, count)
+        for kind, (seconds, count) in sorted(root.totals().items())
+        if count
+    ]
+    entries.append('total;dur={:.1f}'.format(root.seconds * 1000))
+    return ', '.join(entries)
+
+
+def tree(root):
+    return '\n'.join(
+        '{}{} {} {:.1f}ms'.format('  ' * depth, span.name, span.detail,
+                                  (span.seconds or 0) * 1000)
+        for depth, span in root.walk())
+
+
+def dump(profile, name):
+    """Write cProfile stats of a request to BASEDIR/profiles."""
+    directory = os.path.join(settings.config['BASEDIR'], 'profiles')
+    try:
+        os.makedirs(directory, exist_ok=True)
+        now = time.time()
+        filename = os.path.join(directory, '{}.{:03d}-{}.prof'.format(
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(now)),
+            int(now * 1000) % 1000, name))
+        profile.dump_stats(filename)
+        log.info('Wrote {}'.format(filename))
+    except OSError as e:
+        log.error('Writing profile failed: {}'.format(e))
+
+
+def init_app(app):
+    """Install the request hooks of a Flask app, they do nothing while
+    PROFILE is off. Flask is only imported here so the library and the
+    command line can use spans without it."""
+    from flask import before_render_template
+    from flask import g
+    from flask import request
+    from flask import template_rendered
+
+    @app.before_request
+    def start_request():
+        if not settings.config['PROFILE']:
+            return
+        g.profile_span = _local.span = Span('request', request.path)
+        rate = settings.config['PROFILE_SAMPLE']
+        if rate and random.random() < rate and _sampling.acquire(False):
+            g.profile = cProfile.Profile()
+            g.profile.enable()
+
+    @app.after_request
+    def finish_request(response):
+        root = g.pop('profile_span', None)
+        if root is None:
+            return response
+        profile = g.pop('profile', None)
+        if profile is not None:
+            profile.disable()
+            _sampling.release()
+        root.finish()
+        _local.span = None
+        response.headers['Server-Timing'] = servertiming(root)
+        if root.seconds >= settings.config['PROFILE_SLOW']:
+            log.info('Slow request {} {:.2f}s\n{}'.format(
+                request.path, root.seconds, tree(root)))
+        if profile is not None:
+            dump(profile, request.endpoint or 'request')
+        return response
+
+    @app.teardown_request
+    def reset_request(error=None):
+        # Requests failing before finish_request leave their span behind.
+        profile = g.pop('profile', None)
+        if profile is not None:
+            profile.disable()
+            _sampling.release()
+        g.pop('profile_span', None)
+        _local.span = None
+
+    def rendering(sender, template, context, **extra):
+        enter('render', template.name)
+
+    def rendered(sender, template, context, **extra):
+        render = current()
+        if render is not None and render.name == 'render':
+            leave(render)
+
+    before_render_template.connect(rendering, app, weak=False)
+    template_rendered.connect(rendered, app, weak=False)
@@ -0,0 +1,70 @@
+import collections
+import threading
+
+from app.rulesearch import RuleIndex
+
+
+class RulebaseCache(object):
+    """Filtered rulebases keyed by layer UID and domain.
+
+    Recently used layers are held in memory, every layer is also persisted
+    to the local DB so it survives a restart. An entry is only returned
+    while its revision matches the last published session on the server.
+    """
+
+    def __init__(self, dbobj, size=10):
+        self.dbobj = dbobj
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def get(self, layer_uid, domain, revision):
+        key = (layer_uid, domain or '')
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is None:
+            entry = self.dbobj.load_rulebase(*key)
+            if entry is None:
+                return None
+            self.remember(key, entry)
+        if entry[0] != revision:
+            return None
+        return entry[1]
+
+    def put(self, layer_uid, domain, revision, rules):
+        key = (layer_uid, domain or '')
+        self.remember(key, (revision, rules))
+        self.dbobj.save_rulebase(key[0], key[1], revision, rules)
+
+    def invalidate(self, layer_uid, domain):
+        key = (layer_uid, domain or '')
+        with self.lock:
+            self.entries.pop(key, None)
+            self.indexes.pop(key, None)
+        self.dbobj.delete_rulebase(*key)
+
+    def index(self, layer_uid, domain, revision):
+        """Search index of a cached layer, built on first use."""
+        rules = self.get(layer_uid, domain, revision)
+        if rules is None:
+            return None
+        key = (layer_uid, domain or '')
+        with self.lock:
+            index = self.indexes.get(key)
+        if index is None or index.rules is not rules:
+            index = RuleIndex(rules, self.dbobj)
+            with self.lock:
+                self.indexes[key] = index
+        return index
+
+    def remember(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self.indexes.pop(key, None)
+            while len(self.entries) > self.size:
+                evicted, _ = self.entries.popitem(last=False)
+                self.indexes.pop(evicted, None)
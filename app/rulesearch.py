@@ -0,0 +1,140 @@
+import collections
+import ipaddress
+
+from app.ipindex import addressindex
+
+# Query field prefixes and the filtered rule field they search.
+FIELDS = {
+    'src': 'source',
+    'source': 'source',
+    'dst': 'destination',
+    'destination': 'destination',
+    'svc': 'service',
+    'service': 'service',
+    'target': 'target',
+    'install-on': 'target'
+}
+OBJECT_FIELDS = ('source', 'destination', 'service', 'target')
+# Fields searched by address, services and targets only match by name.
+ADDRESS_FIELDS = ('source', 'destination')
+
+
+def parse_network(value):
+    try:
+        return ipaddress.ip_network(value, strict=False)
+    except ValueError:
+        return None
+
+
+def port_matches(port, value):
+    """Whether a service port or port range such as 1024-65535 covers
+    value."""
+    if not port or not value.isdigit():
+        return False
+    low, _, high = str(port).partition('-')
+    try:
+        return int(low) <= int(value) <= int(high or low)
+    except ValueError:
+        return False
+
+
+class RuleIndex(object):
+    """Inverted index over the filtered rules of a layer.
+
+    A query is a list of whitespace separated terms that all have to
+    match. A term is a name, UID, rule number, address, prefix or port,
+    optionally limited to one field with src:, dst:, svc: or target:,
+    e.g. "dst:10.1.0.0/16 svc:443". Addresses, group members and ports are
+    resolved from the objects in the local DB.
+    """
+
+    def __init__(self, rules, dbobj):
+        self.rules = rules
+        self.dbobj = dbobj
+        self.uids = {field: collections.defaultdict(set)
+                     for field in OBJECT_FIELDS}
+        self.names = {field: collections.defaultdict(set)
+                      for field in OBJECT_FIELDS}
+        self.text = collections.defaultdict(set)
+        self.numbers = {}
+        self.ports = {}
+        for position, rule in enumerate(rules):
+            if rule['type'] != 'rule':
+                continue
+            self.numbers[str(rule['number'])] = position
+            for value in (rule['name'], rule['action'], rule['track']):
+                self.text[str(value).lower()].add(position)
+            for field in OBJECT_FIELDS:
+                for name, uid in rule[field]:
+                    self.uids[field][uid].add(position)
+                    self.names[field][name.lower()].add(position)
+        for uid, cpobject in dbobj.get_objects(self.uids['service']).items():
+            if 'port' in cpobject:
+                self.ports[uid] = cpobject['port']
+
+    def search(self, query):
+        """Positions of the rules matching every term of query."""
+        matched = None
+        for term in query.split():
+            field, _, value = term.partition(':')
+            if field not in FIELDS or not value:
+                # Bare terms and IPv6 addresses search every field.
+                field, value = '', term
+            positions = self.term(FIELDS.get(field), value)
+            matched = positions if matched is None else matched & positions
+        return matched or set()
+
+    def term(self, field, value):
+        fields = [field] if field else OBJECT_FIELDS
+        lowered = value.lower()
+        positions = set()
+        network = parse_network(value)
+        for name in fields:
+            positions.update(self.uids[name].get(value, ()))
+            for objname, found in self.names[name].items():
+                if lowered in objname:
+                    positions.update(found)
+            if network is not None and name in ADDRESS_FIELDS:
+                positions.update(self.covering(name, network))
+            if name == 'service':
+                for uid, port in self.ports.items():
+                    if port_matches(port, value):
+                        positions.update(self.uids[name].get(uid, ()))
+        if not field:
+            for text, found in self.text.items():
+                if lowered in text:
+                    positions.update(found)
+            if value in self.numbers:
+                positions.add(self.numbers[value])
+        return positions
+
+    def covering(self, field, network):
+        """Rules whose field holds Any, an object overlapping network or a
+        group holding one."""
+        positions = set(self.names[field].get('any', ()))
+        direct, groups = addressindex(self.dbobj).matching(network)
+        for uid in direct | groups:
+            positions.update(self.uids[field].get(uid, ()))
+        return positions
+
+    def referencing(self, uids, fields=('source', 'destination'),
+                    include_any=False):
+        """Fields of each rule position referencing one of uids."""
+        found = collections.defaultdict(list)
+        for field in fields:
+            positions = set()
+            for uid in uids:
+                positions.update(self.uids[field].get(uid, ()))
+            if include_any:
+                positions.update(self.names[field].get('any', ()))
+            for position in positions:
+                found[position].append(field)
+        return collections.OrderedDict(sorted(found.items()))
+
+    def filter(self, query):
+        """Rules matching query in order, with their sections."""
+        positions = self.search(query)
+        return [
+            rule for position, rule in enumerate(self.rules)
+            if rule['type'] == 'section' or position in positions
+        ]
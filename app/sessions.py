@@ -0,0 +1,88 @@
+import logging
+import threading
+import time
+import uuid
+
+from app import settings
+from app.checkpoint import CheckPoint_API
+from app.jobs import jobqueue
+
+log = logging.getLogger(__name__)
+
+
+class SessionManager(object):
+    """API sessions of the logged in users keyed by their flask-login id.
+
+    Each login gets its own CheckPoint_API so users no longer share a sid,
+    layer or report. Sessions on the same management server share its
+    local DB and rulebase cache. Sessions idle for longer than idle seconds
+    are logged out, unless one of their jobs is still running.
+    """
+
+    def __init__(self, idle=1800):
+        self.idle = idle
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.evicted = time.time()
+
+    def create(self):
+        """Key and API client of a new session."""
+        apisession = CheckPoint_API()
+        key = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[key] = apisession
+        self.evict()
+        return key, apisession
+
+    def get(self, key):
+        with self.lock:
+            apisession = self.sessions.get(key)
+        if apisession is not None:
+            apisession.last_used = time.time()
+        self.evict()
+        return apisession
+
+    def owned(self, owner):
+        """Most recently used session of a job owner."""
+        with self.lock:
+            found = [
+                apisession for apisession in self.sessions.values()
+                if apisession.sid and apisession.owner == owner
+            ]
+        if not found:
+            return None
+        return max(found, key=lambda apisession: apisession.last_used)
+
+    def remove(self, key):
+        with self.lock:
+            apisession = self.sessions.pop(key, None)
+        if apisession is not None:
+            apisession.transport.close()
+        return apisession
+
+    def evict(self):
+        """Log out sessions idle for too long, checked once a minute."""
+        now = time.time()
+        with self.lock:
+            if now - self.evicted < 60:
+                return
+            self.evicted = now
+            idle = [
+                key for key, apisession in self.sessions.items()
+                if now - apisession.last_used > self.idle
+                and not jobqueue.busy(apisession.owner)
+            ]
+            evicted = [self.sessions.pop(key) for key in idle]
+        for apisession in evicted:
+            log.info('Evicting idle session of {}'.format(
+                apisession.owner))
+            if apisession.sid:
+                apisession.logout()
+            apisession.transport.close()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.sessions)
+
+
+sessions = SessionManager(settings.config['SESSION_IDLE'])
@@ -0,0 +1,76 @@
+"""Configuration shared by the web app, the CLI and library use.
+
+The web app copies these into its Flask config and points config at it,
+so modules always read the active values through settings.config.
+"""
+import os
+import platform
+
+ostype = platform.system()
+
+if ostype == 'Windows':
+    BASEDIR = '{}\\'.format(os.getcwd())
+if ostype == 'Linux':
+    BASEDIR = '/var/log/cpapi/'
+# Local DBs, job records and the log live here, CPAPI_BASEDIR overrides it
+# for scripts that cannot write to the default.
+BASEDIR = os.environ.get('CPAPI_BASEDIR', BASEDIR)
+
+config = {}
+config['version'] = '1.4.3'
+config['BASEDIR'] = BASEDIR
+# Management API transport, the pool is reused for every call in a session.
+config['API_POOL_SIZE'] = 10
+config['API_RETRIES'] = 3
+config['API_BACKOFF'] = 0.5
+# Parallel page requests per session, keep at or below API_POOL_SIZE.
+config['API_CONCURRENCY'] = 4
+# Seconds an incremental object sync reaches back past the last sync to
+# cover clock skew with the management server.
+config['SYNC_OVERLAP'] = 300
+# Layers kept in memory by the rulebase cache, all are persisted to the DB.
+config['RULEBASE_CACHE_SIZE'] = 10
+# Rules per window of the policy view and results per object picker page.
+config['POLICY_WINDOW'] = 50
+config['PICKER_PAGE'] = 50
+# Task polling interval bounds and overall deadline in seconds.
+config['TASK_POLL_INITIAL'] = 0.5
+config['TASK_POLL_MAX'] = 5
+config['TASK_DEADLINE'] = 900
+# Seconds commands, targets and layers are cached per server and domain.
+config['PREDATA_TTL'] = 3600
+# Seconds before the API session timeout a page load sends a keepalive.
+config['KEEPALIVE_MARGIN'] = 120
+# Seconds before an unused web session is logged out.
+config['SESSION_IDLE'] = 1800
+# Background job workers and seconds finished jobs are kept for polling.
+config['JOB_WORKERS'] = 2
+config['JOB_KEEP'] = 86400
+# Objects published together by an import, 0 publishes once at the end.
+config['IMPORT_CHUNK'] = 0
+# Parse show-* pages while they download instead of holding the whole
+# reply, needs ijson. Streamed objects are written to the local DB in
+# batches and their pages are not bounded by PAGE_BYTES.
+config['API_STREAM'] = False
+config['STREAM_BATCH'] = 100
+# Page sizes of show-* commands adapt to take about PAGE_SECONDS and at
+# most PAGE_BYTES, between PAGE_MIN and the API maximum PAGE_MAX items.
+config['PAGE_SECONDS'] = 2
+config['PAGE_BYTES'] = 8 * 1024 * 1024
+config['PAGE_MIN'] = 50
+config['PAGE_MAX'] = 500
+# Request profiling, off unless CPAPI_PROFILE is set: Server-Timing headers,
+# span trees of requests slower than PROFILE_SLOW seconds in the log and
+# cProfile stats of a PROFILE_SAMPLE fraction of requests in BASEDIR.
+config['PROFILE'] = bool(os.environ.get('CPAPI_PROFILE'))
+config['PROFILE_SLOW'] = 1.0
+config['PROFILE_SAMPLE'] = 0
+# (connect, read) timeouts, per command overrides fall back to API_TIMEOUT.
+config['API_TIMEOUT'] = (15, 300)
+config['API_TIMEOUTS'] = {
+    'login': (15, 60),
+    'logout': (15, 30),
+    'keepalive': (15, 30),
+    'publish': (15, 600),
+    'run-script': (15, 600)
+}
@@ -1,16 +1,138 @@
+var rulestate = null;
+
 function rulesearch() {
-    var string = document.getElementById("searchstring").value;
     var table = document.getElementById("tbody");
-    for (var i = 0, row; row = table.rows[i]; i++) {
-        for (var j = 0, col; col = row.cells[j]; j++) {
-            data = col.innerText;
-            if (data.includes(string)) {
-                row.removeAttribute("style");
-                break;
+    while (table.firstChild) {
+        table.removeChild(table.firstChild);
+    }
+    rulestate.search = document.getElementById("searchstring").value;
+    rulestate.offset = 0;
+    rulestate.total = null;
+    rulestate.section = null;
+    rulestate.generation += 1;
+    rulestate.loading = false;
+    loadrules();
+}
+
+function rulecell(row, text) {
+    var cell = row.insertCell();
+    cell.textContent = text;
+    return cell;
+}
+
+function objectcell(row, objects, negate, plain) {
+    var cell = row.insertCell();
+    if (negate) {
+        cell.className = "negatedcell";
+        cell.appendChild(document.createTextNode("-----Negated-----"));
+        cell.appendChild(document.createElement("br"));
+    }
+    objects.forEach(function(object) {
+        if (object[0] == plain) {
+            cell.appendChild(document.createTextNode(object[0]));
+        } else {
+            var link = document.createElement("a");
+            link.href = "/showobject/" + object[1];
+            link.target = "_blank";
+            link.textContent = object[0];
+            cell.appendChild(link);
+            cell.appendChild(document.createElement("br"));
+        }
+    });
+}
+
+function addrule(table, rule) {
+    var row = table.insertRow();
+    if (rule["type"] == "section") {
+        row.className = "rulesection";
+        rulecell(row, rule["name"]).colSpan = 9;
+        return;
+    }
+    if (rule["enabled"] == true) {
+        rulecell(row, rule["number"]);
+    } else {
+        row.className = "disabledrule";
+        rulecell(row, rule["number"] + " X");
+    }
+    rulecell(row, rule["name"]);
+    objectcell(row, rule["source"], rule["source-negate"], "Any");
+    objectcell(row, rule["destination"], rule["destination-negate"], "Any");
+    objectcell(row, rule["service"], rule["service-negate"], "Any");
+    rulecell(row, rule["action"]);
+    rulecell(row, rule["track"]);
+    objectcell(row, rule["target"], false, "Policy Targets");
+    var form = document.createElement("form");
+    form.method = "post";
+    form.action = "";
+    var button = document.createElement("input");
+    button.type = "image";
+    button.name = "delete";
+    button.value = rule["number"];
+    button.src = table.dataset.delete;
+    form.appendChild(button);
+    if (rule["uid"]) {
+        var uid = document.createElement("input");
+        uid.type = "hidden";
+        uid.name = "uid";
+        uid.value = rule["uid"];
+        form.appendChild(uid);
+    }
+    row.insertCell().appendChild(form);
+}
+
+function loadrules() {
+    if (rulestate.loading ||
+        (rulestate.total !== null && rulestate.offset >= rulestate.total)) {
+        return;
+    }
+    var table = document.getElementById("tbody");
+    var status = document.getElementById("rulestatus");
+    var generation = rulestate.generation;
+    rulestate.loading = true;
+    status.textContent = "Loading rules...";
+    $.getJSON("/policy/rules", {
+        layer: table.dataset.layer,
+        offset: rulestate.offset,
+        limit: table.dataset.window,
+        q: rulestate.search
+    }, function(data) {
+        if (generation != rulestate.generation) {
+            return;
+        }
+        if (data["job"]) {
+            // The layer is loaded in the background before it is searched.
+            status.textContent = "Loading layer...";
+            waitrules(data["job"], generation);
+            return;
+        }
+        var loaded = 0;
+        data["rules"].forEach(function(rule, index) {
+            if (rule["type"] == "section") {
+                // A window repeats the section its first rule belongs to.
+                if (index == 0 && rule["name"] == rulestate.section) {
+                    return;
+                }
+                rulestate.section = rule["name"];
             } else {
-                row.style.display = "none";
+                loaded += 1;
             }
-        }
+            addrule(table, rule);
+        });
+        rulestate.total = data["total"];
+        rulestate.offset = loaded ? rulestate.offset + loaded : data["total"];
+        rulestate.loading = false;
+        status.textContent = "Showing " + Math.min(rulestate.offset, data["total"]) +
+            " of " + data["total"] + " rules";
+        morerules();
+    }).fail(function() {
+        rulestate.loading = false;
+        status.textContent = "Failed to load rules.";
+    });
+}
+
+function morerules() {
+    if (window.innerHeight + window.scrollY >= document.body.offsetHeight - 500) {
+        loadrules();
     }
 }
 
@@ -50,7 +172,107 @@ function disablemethods() {
     }
 }
 
+function jobmessage(job) {
+    var message = job.kind + " " + job.status;
+    if (job.error) {
+        return message + ": " + job.error;
+    }
+    if (job.total) {
+        message += ", " + job.done + " of " + job.total;
+    }
+    return message + (job.message ? " " + job.message : "");
+}
+
+function addresults(results) {
+    var target = $("#commandresults");
+    $.each(results, function(i, task) {
+        var div = $("<div>").addClass("commandresponse");
+        div.append($("<label>").append($("<b>").text(
+            task.target + " \u2010\u2010 " + task.status)));
+        div.append($("<pre>").text("Response:\n" + task.response));
+        target.append("<br>", div);
+    });
+}
+
+function addimportrows(results) {
+    var table = document.getElementById("importresults");
+    results.forEach(function(result) {
+        var row = table.insertRow();
+        ["row", "type", "name", "status", "message"].forEach(function(key) {
+            rulecell(row, result[key]);
+        });
+    });
+}
+
+function polljob(since) {
+    var status = document.getElementById("jobstatus");
+    $.getJSON("/jobs/" + status.dataset.job, {since: since}, function(job) {
+        if (document.getElementById("commandresults")) {
+            addresults(job.results);
+        }
+        if (document.getElementById("importresults")) {
+            addimportrows(job.results);
+        }
+        $("#jobmessage").text(jobmessage(job));
+        if (job.status == "queued" || job.status == "running") {
+            setTimeout(function() { polljob(job.count); }, 1000);
+            return;
+        }
+        $("#jobcancel").remove();
+        if (job.status == "finished" && status.dataset.done) {
+            window.location = status.dataset.done;
+        } else if (job.status == "finished") {
+            $(status).remove();
+        }
+    });
+}
+
+function canceljob() {
+    var status = document.getElementById("jobstatus");
+    $.post("/jobs/" + status.dataset.job + "/cancel");
+    $("#jobcancel").prop("disabled", true);
+}
+
+function waitrules(job, generation) {
+    $.getJSON("/jobs/" + job, function(data) {
+        if (generation != rulestate.generation) {
+            return;
+        }
+        if (data.status == "queued" || data.status == "running") {
+            setTimeout(function() { waitrules(job, generation); }, 1000);
+        } else if (data.status == "finished") {
+            rulestate.loading = false;
+            loadrules();
+        } else {
+            rulestate.loading = false;
+            document.getElementById("rulestatus").textContent =
+                "Failed to load rules: " + (data.error || data.status);
+        }
+    });
+}
+
 $(document).ready(function() {
-    console.log('do something')
     $('.selectjs').select2();
+    $('.selectajax').each(function() {
+        var kind = $(this).data('kind');
+        $(this).select2({
+            ajax: {
+                url: '/objects',
+                dataType: 'json',
+                delay: 250,
+                data: function(params) {
+                    return {kind: kind, q: params.term || '', page: params.page || 1};
+                }
+            }
+        });
+    });
+    if (document.getElementById("tbody")) {
+        rulestate = {search: "", offset: 0, total: null, section: null,
+                     generation: 0, loading: false};
+        $(window).on("scroll", morerules);
+        loadrules();
+    }
+    if (document.getElementById("jobstatus")) {
+        polljob(0);
+    }
 });
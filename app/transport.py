@@ -0,0 +1,238 @@
+import json
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPSConnection
+from urllib3.connectionpool import HTTPSConnectionPool
+from urllib3.exceptions import MaxRetryError
+from urllib3.util.retry import Retry
+
+from app.metrics import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+def loads(content):
+    """Decode a JSON body, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+class APIResponse(object):
+    """Reply of an API call whose JSON body is decoded once.
+
+    Behaves like the requests.Response it wraps, json() and data return the
+    same decoded body however often they are called. seconds is the time
+    the call took and sent the size of the request body.
+    """
+
+    def __init__(self, response, seconds=0, sent=0):
+        self.response = response
+        self.seconds = seconds
+        self.sent = sent
+        self._data = None
+        self._error = None
+
+    @property
+    def data(self):
+        if self._data is None and self._error is None:
+            try:
+                self._data = loads(self.response.content)
+            except ValueError as e:
+                self._error = e
+        if self._error is not None:
+            raise self._error
+        return self._data
+
+    def json(self):
+        return self.data
+
+    @property
+    def status_code(self):
+        return self.response.status_code
+
+    @property
+    def text(self):
+        return self.response.text
+
+    @property
+    def content(self):
+        return self.response.content
+
+    @property
+    def waited(self):
+        """Seconds until the reply headers arrived."""
+        return self.response.elapsed.total_seconds()
+
+    @property
+    def retries(self):
+        """Times urllib3 sent the request again before this reply."""
+        retries = getattr(self.response.raw, 'retries', None)
+        return len(getattr(retries, 'history', None) or ())
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def __repr__(self):
+        return '<APIResponse [{}]>'.format(self.status_code)
+
+
+class StreamedPage(object):
+    """JSON object reply parsed while it downloads, needs ijson.
+
+    Iterating yields (key, item) for each item of the top level arrays named
+    in keys as soon as it is complete, items of other arrays are skipped
+    without being built. The top level scalars such as total are in fields
+    once the reply was read to the end, see finish().
+    """
+
+    def __init__(self, response, keys):
+        self.response = response
+        self.keys = set(keys)
+        self.fields = {}
+        response.raw.decode_content = True
+        self.events = ijson.parse(response.raw, use_float=True)
+
+    def __iter__(self):
+        builder = None
+        building = None
+        depth = 0
+        for prefix, event, value in self.events:
+            if builder is not None:
+                builder.event(event, value)
+                if event in ('start_map', 'start_array'):
+                    depth += 1
+                elif event in ('end_map', 'end_array'):
+                    depth -= 1
+                if not depth:
+                    yield building, builder.value
+                    builder = None
+                continue
+            key, dot, rest = prefix.partition('.')
+            if key in self.keys and rest == 'item':
+                if event in ('start_map', 'start_array'):
+                    builder = ijson.ObjectBuilder()
+                    building = key
+                    builder.event(event, value)
+                    depth = 1
+                else:
+                    yield key, value
+            elif not dot and event in ('string', 'number', 'boolean', 'null'):
+                self.fields[prefix] = value
+
+    def finish(self):
+        """Read the rest of the reply and return its top level scalars."""
+        for _ in self:
+            pass
+        return self.fields
+
+    def close(self):
+        self.response.close()
+
+
+def readonly(url):
+    """Whether the command of an API URL only reads, show-* or keepalive."""
+    command = url.rstrip('/').rsplit('/', 1)[-1]
+    return command.startswith('show-') or command == 'keepalive'
+
+
+class CommandRetry(Retry):
+    """Retry sending only read-only commands again after an error status.
+
+    A 502 from a front end may come after the management server applied a
+    write, so publish, add-* and the like are only retried when the
+    connection could not be made.
+    """
+
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        if error is None and response is not None and not readonly(
+                url or ''):
+            raise MaxRetryError(_pool, url, None)
+        return super().increment(method, url, response, error, _pool,
+                                 _stacktrace)
+
+
+class CountingAdapter(HTTPAdapter):
+    """HTTPAdapter whose HTTPS connections report every TLS handshake."""
+
+    def __init__(self, on_connect, **kwargs):
+        self.on_connect = on_connect
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        on_connect = self.on_connect
+
+        class CountingConnection(HTTPSConnection):
+            def connect(self):
+                on_connect()
+                super().connect()
+
+        class CountingPool(HTTPSConnectionPool):
+            ConnectionCls = CountingConnection
+
+        self.poolmanager.pool_classes_by_scheme = dict(
+            self.poolmanager.pool_classes_by_scheme, https=CountingPool)
+
+
+class APITransport(object):
+    """Persistent keep-alive HTTPS transport for Management API calls.
+
+    A single requests.Session is kept for the life of the API session so
+    calls reuse pooled TLS connections instead of opening a new one each.
+    """
+
+    def __init__(self, pool_size=10, retries=3, backoff=0.5):
+        self.handshakes = 0
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        # Only connection failures are retried for every command, gateway
+        # errors for read-only ones. A read timeout on a write command may
+        # already have been applied.
+        retry = CommandRetry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503),
+            allowed_methods=frozenset(['POST']),
+            raise_on_status=False)
+        adapter = CountingAdapter(
+            self._count_handshake,
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            pool_block=True,
+            max_retries=retry)
+        self.session.mount('https://', adapter)
+
+    def _count_handshake(self):
+        with self._lock:
+            self.handshakes += 1
+        metrics.handshake()
+
+    def post(self, url, data, headers, timeout, stream=False):
+        """POST data and return the reply as an APIResponse. With stream
+        the body is left on the connection for a StreamedPage."""
+        started = time.time()
+        # Permanently Disable verify for now. Passed per request because a
+        # session level verify is overridden by REQUESTS_CA_BUNDLE.
+        response = self.session.post(
+            url, data=data, headers=headers, timeout=timeout, verify=False,
+            stream=stream)
+        return APIResponse(response, time.time() - started, len(data))
+
+    def close(self):
+        self.session.close()
@@ -1,21 +1,50 @@
+import csv
+import io
+
+from flask import Response
+from flask import abort
+from flask import jsonify
 from flask import render_template
 from flask import redirect
 from flask import request
 from flask import session
 
 from flask_login import UserMixin
+from flask_login import current_user
 from flask_login import login_required
 from flask_login import login_user
 from flask_login import logout_user
 from flask_login import LoginManager
+from werkzeug.local import LocalProxy
 
-from app import app
-from app.checkpoint import CheckPoint_API
+from app import importer
+from app import jobs
+from app.jobs import jobqueue
+from app.metrics import metrics as apimetrics
+from app.sessions import sessions
+from app.web import app
 
 login_manager = LoginManager()
 login_manager.init_app(app)
 
-apisession = CheckPoint_API()
+
+def current_session():
+    """API session of the logged in user, 401 when there is none."""
+    apisession = sessions.get(current_user.get_id())
+    if apisession is None:
+        abort(401)
+    return apisession
+
+
+def job_session(job):
+    """API session a background job runs in."""
+    apisession = sessions.owned(job.owner)
+    if apisession is None:
+        raise jobs.JobError('{} is not logged in.'.format(job.owner))
+    return apisession
+
+
+apisession = LocalProxy(current_session)
 
 
 class User(UserMixin):
@@ -25,6 +54,8 @@ class User(UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id):
+    if sessions.get(user_id) is None:
+        return None
     return User(user_id)
 
 
@@ -36,19 +67,12 @@ def page_not_found(e):
 @app.before_request
 def before_request():
     keepalive_pages = [
-        'custom', 'addhost', 'addnetwork', 'addgroup'
+        'custom', 'addhost', 'addnetwork', 'addgroup', 'bulkimport',
         'policy', 'showobject', 'commands', 'logout'
     ]
-    if request.endpoint in keepalive_pages:
-        if hasattr(apisession, 'ipaddress'):
-            response = apisession.keepalive()
-            try:
-                if response.status_code != 200:
-                    return redirect('/login')
-            except AttributeError:
-                return redirect('/login')
-        else:
-            return redirect('/login')
+    # Only sends a keepalive when the session is close to its timeout.
+    if request.endpoint in keepalive_pages and not apisession.alive():
+        return redirect('/login')
 
 
 @app.route('/')
@@ -67,9 +91,11 @@ def login():
         domain = request.form.get('domain', None)
         app.logger.info('Login attempt {}@{} > {}'.format(
             username, request.remote_addr, ipaddress))
+        key, apisession = sessions.create()
         response = apisession.login(ipaddress, username, password, domain)
         try:
             if response.status_code != 200:
+                sessions.remove(key)
                 try:
                     return render_template(
                         'login.html', feedback=response.json()['message'])
@@ -79,16 +105,15 @@ def login():
                         'login.html', feedback=response.text)
         # No connection happened so there is no status code
         except AttributeError as e:
+            sessions.remove(key)
             return render_template('login.html', feedback=response)
 
         app.logger.info('Login Success {}@{} > {}'.format(
             username, request.remote_addr, ipaddress))
-        apisession.sid = response.json()['sid']
-        apisession.version = response.json()['api-server-version']
-        apisession.ipaddress = ipaddress
-        user = User(apisession.sid)
+        user = User(key)
         login_user(user)
         apisession.pre_data()
+        jobqueue.resume(apisession.owner)
         return redirect('/custom')
 
 
@@ -97,6 +122,7 @@ def login():
 def logout():
     if request.method == 'GET':
         apisession.logout()
+        sessions.remove(current_user.get_id())
         logout_user()
         return redirect('/login')
 
@@ -104,36 +130,48 @@ def logout():
 @app.route('/settings', methods=['GET', 'POST'])
 def settings():
     if request.method == 'GET':
+        job = jobqueue.get(request.args.get('job', ''), apisession.owner)
+        if job is not None and job.kind == 'sync' and job.results:
+            return render_template('settings.html', **job.results[-1])
         apisession.verify_obj()
         return render_template(
             'settings.html',
             remote=apisession.remote_obj,
-            local=apisession.local_obj)
+            local=apisession.local_obj,
+            job=job)
     if request.method == 'POST':
-        apisession.verify_obj()
-        if apisession.local_obj != 0:
-            if apisession.local_obj != apisession.remote_obj:
-                if apisession.local_obj > apisession.remote_obj:
-                    app.logger.info(
-                        'Deleting local objects that are inconsistent.')
-                    apisession.deldifobjects()
-                    apisession.getdifobjects()
-                else:
-                    app.logger.info(
-                        'Retreiving remote objects that are inconsistent.')
-                    apisession.getdifobjects()
-            else:
-                # Use js in future to disable button if objects are equal.
-                app.logger.warn('Equal Retrieve attempted.')
-                pass
-        else:
-            app.logger.info('Initial retrieve of objects.')
-            apisession.getallobjects()
-        apisession.verify_obj()
-        return render_template(
-            'settings.html',
-            remote=apisession.remote_obj,
-            local=apisession.local_obj)
+        job = jobqueue.submit(
+            'sync', apisession.owner, unique=True,
+            full='full' in request.form)
+        return redirect('/settings?job={}'.format(job.id))
+
+
+@jobs.handler('sync', restartable=True)
+def sync_job(job, full=False):
+    apisession = job_session(job)
+    handshakes = apisession.transport.handshakes
+    apisession.syncobjects(full, progress=job.progress)
+    apisession.verify_obj()
+    app.logger.info('Object sync complete, {} TLS handshakes.'.format(
+        apisession.transport.handshakes - handshakes))
+    yield {
+        'remote': apisession.remote_obj,
+        'local': apisession.local_obj,
+        'report': dict(apisession.sync_report),
+        'calls': apisession.sync_calls
+    }
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """API call metrics in the Prometheus text format."""
+    gauges = {
+        'cpapi_sessions': ('Logged in API sessions.', len(sessions)),
+        'cpapi_jobs_pending': ('Jobs waiting for a worker.',
+                               jobqueue.pending.qsize())
+    }
+    return Response(apimetrics.render(gauges),
+                    mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/custom', methods=['GET', 'POST'])
@@ -278,14 +316,9 @@ def addnetwork():
 @login_required
 def addgroup():
     if request.method == 'GET':
-        all_objects = apisession.get_local_objs()
-        return render_template(
-            'addgroup.html',
-            colors=apisession.all_colors,
-            allobjects=all_objects)
+        return render_template('addgroup.html', colors=apisession.all_colors)
     if request.method == 'POST':
         app.logger.info('Adding Check Point Group.')
-        all_objects = apisession.get_local_objs()
         if 'groupname' in request.form.keys():
             groupname = request.form.get('groupname')
             groupcolor = request.form.get('groupcolor')
@@ -296,24 +329,100 @@ def addgroup():
         return render_template(
             'addgroup.html',
             colors=apisession.all_colors,
-            allobjects=all_objects,
             response=response.text)
 
 
+@app.route('/import', methods=['GET', 'POST'])
+@login_required
+def bulkimport():
+    if request.method == 'GET':
+        return render_template('import.html',
+                               chunk=app.config['IMPORT_CHUNK'])
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        chunk = request.form.get('chunk', app.config['IMPORT_CHUNK'],
+                                 type=int)
+        if upload is None or upload.filename == '':
+            return render_template(
+                'import.html', chunk=chunk, error='No file provided.')
+        if chunk < 0:
+            return render_template(
+                'import.html', chunk=app.config['IMPORT_CHUNK'],
+                error='Objects per publish must be 0 or more.')
+        fmt = 'json' if upload.filename.lower().endswith('.json') else 'csv'
+        try:
+            rows = list(
+                importer.read_rows(
+                    io.TextIOWrapper(upload.stream, encoding='utf-8-sig',
+                                     newline=''), fmt))
+        except (ValueError, csv.Error) as e:
+            return render_template(
+                'import.html', chunk=chunk,
+                error='Unable to read {}: {}'.format(upload.filename, e))
+        app.logger.info('Importing {} rows from {}'.format(
+            len(rows), upload.filename))
+        job = jobqueue.submit(
+            'import', apisession.owner, rows=rows, chunk=chunk)
+        return render_template('import.html', chunk=chunk, job=job)
+
+
+@jobs.handler('import')
+def import_job(job, rows, chunk=0):
+    apisession = job_session(job)
+    job.progress(0, len(rows))
+    for result in importer.Importer(apisession, chunk).run(
+            rows, job.progress):
+        yield result
+
+
+@app.route('/objects', methods=['GET'])
+@login_required
+def objects():
+    """Lazy object picker source in select2 ajax format."""
+    limit = app.config['PICKER_PAGE']
+    page = request.args.get('page', 1, type=int)
+    rows = apisession.dbobj.search_objects(
+        request.args.get('kind', 'network'), request.args.get('q', ''),
+        (page - 1) * limit, limit + 1)
+    return jsonify({
+        'results': [{
+            'id': row[0],
+            'text': '{} - {}'.format(row[1], row[2])
+        } for row in rows[:limit]],
+        'pagination': {
+            'more': len(rows) > limit
+        }
+    })
+
+
 @app.route('/policy', methods=['GET', 'POST'])
 @login_required
 def policy():
     if request.method == 'GET':
         return render_template('policy.html', alllayers=apisession.all_layers)
     if request.method == 'POST':
-        app.logger.info('Retrieving local objects for policy view.')
-        all_objects = apisession.get_local_objs()
         formdata = request.form.to_dict()
+        feedback = None
+        if 'batchmode' in formdata:
+            apisession.batch = 'batch' in formdata
         if 'delete' in formdata:
             rulenum = formdata['delete']
             app.logger.info('Deleting rule number {} from {}'.format(
                 rulenum, apisession.lastlayer))
-            feedback = apisession.delete_rule(rulenum)
+            try:
+                feedback = apisession.delete_rule(rulenum,
+                                                  formdata.get('uid'))
+            except ValueError as e:
+                feedback = str(e)
+        if 'move' in formdata:
+            app.logger.info('Moving rule number {} to {} in {}'.format(
+                formdata['move'], formdata.get('moveto'),
+                apisession.lastlayer))
+            try:
+                feedback = apisession.move_rule(formdata['move'],
+                                                formdata.get('moveto'))
+            except ValueError as e:
+                feedback = str(e)
         if 'add' in formdata:
             ruledata = {
                 'position': request.form.get('position'),
@@ -331,24 +440,65 @@ def policy():
             app.logger.info('Adding rule number {} to {}'.format(
                 ruledata['position'], ruledata['layer']))
             feedback = apisession.add_rule(ruledata)
+        if 'apply' in formdata:
+            app.logger.info('Applying {} rule changes'.format(
+                len(apisession.changes)))
+            feedback = apisession.apply_changes()
+        if 'discard' in formdata:
+            feedback = 'Discarded {} queued changes.'.format(
+                apisession.discard_changes())
         if 'layer' in formdata:
             apisession.lastlayer = formdata['layer']
-            response = apisession.showrulebase(formdata['layer'])
-            return render_template(
-                'policy.html',
-                alllayers=apisession.all_layers,
-                rulebase=response,
-                lastlayer=apisession.lastlayer,
-                allobjects=all_objects)
-        else:
-            app.logger.info('Retrieving rulebase after modification.')
-            response = apisession.showrulebase(apisession.lastlayer)
-            return render_template(
-                'policy.html',
-                alllayers=apisession.all_layers,
-                rulebase=response,
-                lastlayer=apisession.lastlayer,
-                allobjects=all_objects)
+            # Warm the rulebase cache so a search does not wait for it.
+            jobqueue.submit(
+                'rulebase', apisession.owner, unique=True,
+                layer=apisession.lastlayer)
+        # Rows are loaded in windows from /policy/rules by the page.
+        return render_template(
+            'policy.html',
+            alllayers=apisession.all_layers,
+            lastlayer=apisession.lastlayer,
+            feedback=feedback,
+            batch=apisession.batch,
+            changes=apisession.changes,
+            window=app.config['POLICY_WINDOW'])
+
+
+@app.route('/policy/rules', methods=['GET'])
+@login_required
+def policyrules():
+    layer = request.args.get('layer', apisession.lastlayer)
+    offset = request.args.get('offset', 0, type=int)
+    limit = min(
+        request.args.get('limit', app.config['POLICY_WINDOW'], type=int),
+        app.config['POLICY_WINDOW'])
+    window = apisession.rulewindow(
+        layer, offset, limit, request.args.get('q', ''), load=False)
+    if window is None:
+        job = jobqueue.submit(
+            'rulebase', apisession.owner, unique=True, layer=layer)
+        return jsonify({'job': job.id}), 202
+    return jsonify(window)
+
+
+@jobs.handler('rulebase', restartable=True)
+def rulebase_job(job, layer):
+    apisession = job_session(job)
+    yield {'layer': layer, 'rules': len(apisession.showrulebase(layer))}
+
+
+@app.route('/lookup', methods=['GET'])
+@login_required
+def lookup():
+    """Objects and access rules covering an address or prefix."""
+    address = request.args.get('address', '')
+    app.logger.info('Looking up address {}'.format(address))
+    try:
+        response = apisession.lookup(address,
+                                     'any' in request.args)
+    except ValueError:
+        return jsonify({'message': 'Invalid address {}'.format(address)}), 400
+    return jsonify(response)
 
 
 @app.route('/showobject/<cp_objectuid>', methods=['GET'])
@@ -376,8 +526,43 @@ def commands():
         targets = request.form.getlist('target')
         command = request.form.get('script')
         app.logger.info('Running script "{}"'.format(command))
-        response = apisession.runcommand(targets, command)
+        job = jobqueue.submit(
+            'run-script', apisession.owner, targets=targets, script=command)
         return render_template(
-            'commands.html',
-            alltargets=apisession.all_targets,
-            response=response)
+            'commands.html', alltargets=apisession.all_targets, job=job)
+
+
+@jobs.handler('run-script')
+def runscript_job(job, targets, script):
+    apisession = job_session(job)
+    response = apisession.runscript(targets, script)
+    try:
+        if response.status_code != 200 or 'tasks' not in response.data:
+            raise jobs.JobError(response.text)
+    except AttributeError:
+        raise jobs.JobError(response)
+    job.progress(0, len(targets))
+    for done, result in enumerate(
+            apisession.polltasks(response.data['tasks']), 1):
+        yield result
+        job.progress(done)
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+@login_required
+def jobstatus(job_id):
+    """State of a background job and its results after the first since."""
+    job = jobqueue.get(job_id, apisession.owner)
+    if job is None:
+        return jsonify({'message': 'Unknown job {}'.format(job_id)}), 404
+    return jsonify(job.as_dict(request.args.get('since', 0, type=int)))
+
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+@login_required
+def canceljob(job_id):
+    job = jobqueue.cancel(job_id, apisession.owner)
+    if job is None:
+        return jsonify({'message': 'Unknown job {}'.format(job_id)}), 404
+    app.logger.info('Cancelling job {} ({})'.format(job.id, job.kind))
+    return jsonify(job.as_dict(len(job.results)))
@@ -0,0 +1,29 @@
+import logging
+import os
+
+from flask import Flask
+from logging.handlers import RotatingFileHandler
+
+from app import profiling
+from app import settings
+
+# Named after the package so module loggers (app.checkpoint, ...) are its
+# children and templates and static files resolve from the package.
+app = Flask('app')
+app.config.update(settings.config)
+settings.config = app.config
+
+formatter = logging.Formatter('%(asctime)s %(levelname)s - '
+                              '%(filename)s:%(funcName)s:%(lineno)d - '
+                              '%(message)s')
+handler = RotatingFileHandler(
+    '{}cpapi.log'.format(app.config['BASEDIR']),
+    maxBytes=10000000,
+    backupCount=10)
+handler.setFormatter(formatter)
+app.logger.setLevel('DEBUG')
+app.logger.addHandler(handler)
+app.secret_key = os.urandom(25)
+profiling.init_app(app)
+
+from app import views
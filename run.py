@@ -1,3 +1,3 @@
-from app import app
+from app.web import app
 
 app.run(host='0.0.0.0', port=8080)